@@ -6,7 +6,112 @@ import os
 import wave
 from itertools import groupby
 
-import dtw
+import numpy as np
+
+# Steps taken to reach each cell of the alignment
+_START, _DIAG, _HORIZ, _VERT = range(4)
+
+
+def band_limits(x, y, band=0):
+    # both sequences are cumulative proportions rising from 0 to 1, so each
+    # row i should match columns where y falls between x[i - 1] and x[i], and
+    # we extend that span by the band width either side
+    n, m = len(x), len(y)
+    if not band:
+        return np.zeros(n, dtype=int), np.full(n, m - 1)
+    span_end = np.searchsorted(y, x)
+    span_start = np.concatenate([[0], span_end[:-1]])
+    lo = np.maximum.accumulate(span_start - band).clip(0, m - 1)
+    hi = np.maximum.accumulate(span_end + band).clip(0, m - 1)
+    lo[0] = 0
+    hi[-1] = m - 1
+    # each row must overlap the one before for a path to exist
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    return lo, hi
+
+
+def banded_dtw(x, y, band=0):
+    """Align two sequences by DTW within a band of columns in each row
+
+    Uses the symmetric2 step pattern with absolute differences as local
+    costs, as dtw.dtw does by default, but only keeps step choices for cells
+    inside the band. Rows are filled vectorially: horizontal steps are a
+    running minimum over cumulative costs along the row. With the full cost
+    matrix, the path has the same cost as from dtw.dtw, though exact ties
+    may be broken differently.
+
+    With a band, the alignment is approximate: the best path may leave the
+    band. If the path found runs along the edge of the band anywhere, the
+    band is doubled and the alignment redone, which catches most of these
+    cases without filling the full matrix.
+
+    Args:
+      x: 1-D array of query values
+      y: 1-D array of reference values
+      band: Number of extra columns either side of those with matching
+        values in each row (0 to fill the full cost matrix)
+
+    Returns:
+      index1: Array of indices into x along the warping path
+      index2: Array of indices into y along the warping path
+    """
+    m = len(y)
+    while True:
+        if band >= m:
+            band = 0
+        lo, hi = band_limits(x, y, band)
+        index1, index2 = _dtw_in_band(x, y, lo, hi)
+        path_lo, path_hi = lo[index1], hi[index1]
+        on_edge = (((index2 == path_lo) & (path_lo > 0))
+                   | ((index2 == path_hi) & (path_hi < m - 1)))
+        if not band or not on_edge.any():
+            return index1, index2
+        band *= 2
+
+
+def _dtw_in_band(x, y, lo, hi):
+    n, m = len(x), len(y)
+    steps = []
+    prev_cost = None
+    for i in range(n):
+        cols = np.arange(lo[i], hi[i] + 1)
+        dist = np.abs(x[i] - y[cols])
+        cum_dist = np.cumsum(dist)
+        if i == 0:
+            cost = cum_dist
+            step = np.full(len(cols), _HORIZ, dtype=np.int8)
+            step[0] = _START
+        else:
+            diag = np.full(len(cols), np.inf)
+            vert = np.full(len(cols), np.inf)
+            k = cols - lo[i - 1]
+            ok = (k >= 1) & (k <= len(prev_cost))
+            diag[ok] = prev_cost[k[ok] - 1] + 2 * dist[ok]
+            ok = k < len(prev_cost)
+            vert[ok] = prev_cost[k[ok]] + dist[ok]
+            cost = cum_dist + np.minimum.accumulate(np.minimum(diag, vert) - cum_dist)
+            horiz = np.concatenate([[np.inf], cost[:-1] + dist[1:]])
+            # break ties in the same order as dtw.dtw
+            step = np.where(diag <= np.minimum(horiz, vert), _DIAG,
+                            np.where(horiz <= vert, _HORIZ, _VERT)).astype(np.int8)
+        steps.append(step)
+        prev_cost = cost
+
+    i, j = n - 1, m - 1
+    path = [(i, j)]
+    while True:
+        step = steps[i][j - lo[i]]
+        if step == _START:
+            break
+        elif step == _DIAG:
+            i, j = i - 1, j - 1
+        elif step == _HORIZ:
+            j -= 1
+        else:
+            i -= 1
+        path.append((i, j))
+    index1, index2 = np.array(path[::-1]).T
+    return index1, index2
 
 
 if __name__ == '__main__':
@@ -14,6 +119,11 @@ if __name__ == '__main__':
     parser.add_argument('audio_in', help='Directory containing segmented audio files')
     parser.add_argument('text_in', help='Directory containing segmented text transcripts')
     parser.add_argument('data_out', help='Output Kaldi data directory')
+    parser.add_argument('--band', type=int, default=20,
+        help='Only align each audio chunk against text chunks within this many of where '
+        'their cumulative lengths match, giving an approximate alignment. The band is '
+        'widened wherever the best path found runs along its edge (0 to consider all '
+        'pairs, for an exact alignment in memory proportional to both lengths)')
     args = parser.parse_args()
 
     os.makedirs(args.data_out, exist_ok=True)
@@ -53,11 +163,11 @@ if __name__ == '__main__':
                         break
             text_lens = [i / total_text_len for i in text_lens]
 
-            alignment = dtw.dtw(audio_lens, text_lens)
+            index1, index2 = banded_dtw(np.array(audio_lens), np.array(text_lens), args.band)
 
             prev_audio = ''
             prev_text = []
-            for i, j in zip(alignment.index1, alignment.index2):
+            for i, j in zip(index1.tolist(), index2.tolist()):
                 if litir_id >= 307:
                     i += 1  # skip preamble
                 if prev_audio != audios[i] and prev_text:
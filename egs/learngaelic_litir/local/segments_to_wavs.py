@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
 import os
 import shutil
 import wave
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
+from wav_io import read_wav, write_wav
+
 
 def read_segments(segments_file):
     segments = defaultdict(list)
@@ -27,6 +31,50 @@ def read_scp(scp_file):
     return utt_wavs
 
 
+def segment_hashes(segments, utt_wavs):
+    # anything which would change the contents of each output segment,
+    # including the state of its source audio file
+    hashes = {}
+    for src_audio, src_segments in segments.items():
+        if src_audio not in utt_wavs:
+            continue
+        wav_path = utt_wavs[src_audio]
+        st = os.stat(wav_path)
+        for seg, start, end in src_segments:
+            key = repr((seg, src_audio, wav_path, st.st_mtime_ns, st.st_size, start, end))
+            hashes[seg] = hashlib.sha1(key.encode()).hexdigest()
+    return hashes
+
+
+def read_manifest(manifest_file):
+    hashes = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as inf:
+            for line in inf:
+                seg, seg_hash = line.split()
+                hashes[seg] = seg_hash
+    return hashes
+
+
+def write_manifest(manifest_file, hashes):
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as outf:
+        for seg in sorted(hashes):
+            outf.write('{} {}\n'.format(seg, hashes[seg]))
+    os.replace(tmp_file, manifest_file)
+
+
+def select_changed_segments(segments, hashes, old_hashes, wav_out):
+    changed_segments = {}
+    for src_audio, src_segments in segments.items():
+        changed = [(seg, start, end) for seg, start, end in src_segments
+                   if seg in hashes and (old_hashes.get(seg) != hashes[seg] or not
+                       os.path.exists(os.path.join(wav_out, seg + '.wav')))]
+        if changed:
+            changed_segments[src_audio] = changed
+    return changed_segments
+
+
 def get_audio_params(wavf):
     nchannels = wavf.getnchannels()
     sampwidth = wavf.getsampwidth()
@@ -40,7 +88,9 @@ def set_audio_params(wavf, nchannels, sampwidth, framerate):
     wavf.setframerate(framerate)
 
 
-def split_audios(segments, wav_scp, wav_out):
+def split_audios(segments, wav_scp, wav_out, nj=1):
+    if nj > 1:
+        return split_audios_mmap(segments, wav_scp, wav_out, nj)
     pbar = tqdm(desc='Extracting audio segments', total=sum(len(i) for i in segments.values()))
     utt_wavs = read_scp(wav_scp)
     for src_audio, wav_path in utt_wavs.items():
@@ -60,6 +110,31 @@ def split_audios(segments, wav_scp, wav_out):
     pbar.close()
 
 
+def split_audios_mmap(segments, wav_scp, wav_out, nj=8):
+    # map each source file once and write segments straight from slices of
+    # it in a thread pool, with only a few segments per thread queued up
+    pbar = tqdm(desc='Extracting audio segments', total=sum(len(i) for i in segments.values()))
+    utt_wavs = read_scp(wav_scp)
+    pending = deque()
+    with ThreadPoolExecutor(nj) as executor:
+        for src_audio, wav_path in utt_wavs.items():
+            if src_audio not in segments:
+                continue  # no discovered segments
+            c, b, r, frames = read_wav(wav_path)
+            for segment, start, end in segments[src_audio]:
+                seg_start = int(start * r)
+                audio_seg = os.path.join(wav_out, segment + '.wav')
+                pending.append(executor.submit(
+                    write_wav, audio_seg, frames[seg_start:seg_start + int((end - start) * r)], c, b, r))
+                if len(pending) >= 4 * nj:
+                    pending.popleft().result()
+                    pbar.update(1)
+        while pending:
+            pending.popleft().result()
+            pbar.update(1)
+    pbar.close()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('segments', type=str,
@@ -70,6 +145,12 @@ if __name__ == '__main__':
         help='Directory to write segmented WAV files')
     parser.add_argument('--rm', action='store_true',
         help='Delete existing wav_out directory (speeds up writing pre-existing files)')
+    parser.add_argument('--nj', type=int, default=8,
+        help='Number of threads writing segments from memory-mapped source audio '
+        '(1 to read each segment with the wave module instead)')
+    parser.add_argument('--incremental', action='store_true',
+        help='Only write segments which are new or whose source audio or boundaries '
+        'changed since the last run, and delete outputs for removed segments')
     args = parser.parse_args()
 
     segments = read_segments(args.segments)
@@ -79,4 +160,21 @@ if __name__ == '__main__':
         shutil.rmtree(args.wav_out)
     os.makedirs(args.wav_out, exist_ok=True)
 
-    split_audios(segments, args.wav_scp, args.wav_out)
+    if args.incremental:
+        manifest_file = os.path.join(args.wav_out, 'segments_manifest.txt')
+        hashes = segment_hashes(segments, read_scp(args.wav_scp))
+        old_hashes = read_manifest(manifest_file)
+        segments = select_changed_segments(segments, hashes, old_hashes, args.wav_out)
+        removed = [seg for seg in old_hashes if seg not in hashes]
+        for seg in removed:
+            try:
+                os.remove(os.path.join(args.wav_out, seg + '.wav'))
+            except FileNotFoundError:
+                pass
+        num_changed = sum(len(i) for i in segments.values())
+        print("Writing {} new or changed segments, keeping {} unchanged, deleted {} "
+              "removed".format(num_changed, len(hashes) - num_changed, len(removed)))
+
+    split_audios(segments, args.wav_scp, args.wav_out, args.nj)
+    if args.incremental:
+        write_manifest(manifest_file, hashes)
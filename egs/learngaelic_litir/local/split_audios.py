@@ -1,43 +1,225 @@
 #!/usr/bin/env python3
 
 import argparse
+import math
 import os
 from glob import glob
 from itertools import repeat
 from multiprocessing import Pool
 
-from pydub import AudioSegment
-from pydub.silence import split_on_silence
+import numpy as np
 from tqdm import tqdm
 
+from wav_io import read_frames, read_wav_info, write_wav
+
+# Milliseconds of audio to read at once when measuring energy, so memory use
+# doesn't grow with the length of recordings
+BLOCK_MS = 60000
+
+
+def ms_to_frames(ms, framerate):
+    # same rounding as when slicing pydub AudioSegments
+    return (np.asarray(ms) * (framerate / 1000.0)).astype(np.int64)
+
+
+def len_ms(num_frames, framerate):
+    # same rounding as len() of pydub AudioSegments
+    return round(1000 * num_frames / framerate)
+
+
+def total_energy(inf, info):
+    """Sum squared sample values over all audio, reading a block at a time
+
+    Args:
+      inf: WAV file opened in binary mode
+      info: Tuple returned by wav_io.read_wav_info
+
+    Returns:
+      total: Sum of squared samples
+    """
+    _, sampwidth, framerate, num_frames, _ = info
+    acc = np.int64 if sampwidth <= 2 else np.float64
+    block_frames = int(ms_to_frames(BLOCK_MS, framerate))
+    total = 0
+    for start in range(0, num_frames, block_frames):
+        block = read_frames(inf, info, start, min(start + block_frames, num_frames))
+        total += np.square(block.astype(acc)).sum()
+    return total
+
+
+def iter_ms_energies(inf, info):
+    """Sum squared sample values in each millisecond of audio
+
+    Millisecond boundaries are rounded down to whole frames, as when slicing
+    pydub AudioSegments, and any frames past the end of the audio count as
+    silence.
+
+    Args:
+      inf: WAV file opened in binary mode
+      info: Tuple returned by wav_io.read_wav_info
+
+    Yields:
+      energies: Array of summed squared samples per millisecond, for
+        consecutive blocks of up to BLOCK_MS milliseconds
+    """
+    _, sampwidth, framerate, num_frames, _ = info
+    acc = np.int64 if sampwidth <= 2 else np.float64
+    audio_ms = len_ms(num_frames, framerate)
+    for block_start in range(0, audio_ms, BLOCK_MS):
+        block_end = min(block_start + BLOCK_MS, audio_ms)
+        bounds = ms_to_frames(np.arange(block_start, block_end + 1), framerate)
+        sq = np.square(read_frames(inf, info, bounds[0], bounds[-1]).astype(acc)).sum(axis=1)
+        yield np.add.reduceat(sq, bounds[:-1] - bounds[0])
+
+
+def dbfs(total, num_samples, sampwidth):
+    max_amplitude = 2 ** (sampwidth * 8) / 2
+    rms = int(math.sqrt(total / num_samples)) if num_samples else 0
+    if not rms:
+        return -float('inf')
+    return 20 * math.log(rms / max_amplitude, 10)
+
+
+def detect_silence(inf, info, min_silence_len=1000, silence_thresh=-16):
+    """Find silent stretches of audio
+
+    Matches pydub.silence.detect_silence with seek_step=1, but computes the
+    RMS level of every window in each block of audio at once from cumulative
+    energies. Blocks carry over the last min_silence_len milliseconds of
+    energies to finish the windows they start.
+
+    Args:
+      inf: WAV file opened in binary mode
+      info: Tuple returned by wav_io.read_wav_info
+      min_silence_len: Minimum length of silences in milliseconds
+      silence_thresh: Level in dBFS below which audio counts as silent
+
+    Yields:
+      silent_range: List of [start, end] silence in milliseconds
+    """
+    nchannels, sampwidth, framerate, num_frames, _ = info
+    if len_ms(num_frames, framerate) < min_silence_len:
+        return
+    thresh = 10 ** (silence_thresh / 20) * 2 ** (sampwidth * 8) / 2
+    carry = np.zeros(0, dtype=np.int64)
+    carry_start = 0
+    current = None  # [first, last] start of silent windows in current range
+    for energies in iter_ms_energies(inf, info):
+        energies = np.concatenate([carry, energies])
+        # windows starting here which end within the energies read so far
+        starts = np.arange(len(energies) - min_silence_len + 1)
+        cum_energies = np.concatenate([[0], np.cumsum(energies)])
+        window_energies = cum_energies[starts + min_silence_len] - cum_energies[starts]
+        starts += carry_start
+        num_samples = (ms_to_frames(starts + min_silence_len, framerate)
+                       - ms_to_frames(starts, framerate)) * nchannels
+        rms = np.floor(np.sqrt(window_energies / num_samples))
+        silence_starts = starts[rms <= thresh]
+        carry_start += len(starts)
+        carry = energies[len(starts):]
+
+        if not len(silence_starts):
+            continue
+        # silent windows closer together than min_silence_len are merged
+        if current is not None and silence_starts[0] - current[1] > min_silence_len:
+            yield [current[0], current[1] + min_silence_len]
+            current = None
+        gaps = np.flatnonzero(np.diff(silence_starts) > min_silence_len)
+        range_starts = silence_starts[np.concatenate([[0], gaps + 1])].tolist()
+        range_lasts = silence_starts[np.concatenate([gaps, [len(silence_starts) - 1]])].tolist()
+        if current is not None:
+            range_starts[0] = current[0]
+        for start, last in zip(range_starts[:-1], range_lasts[:-1]):
+            yield [start, last + min_silence_len]
+        current = [range_starts[-1], range_lasts[-1]]
+    if current is not None:
+        yield [current[0], current[1] + min_silence_len]
+
+
+def split_on_silence(inf, info, min_silence_len=1000, silence_thresh=-16, keep_silence=100):
+    """Find chunks of audio separated by silences
+
+    Matches pydub.silence.split_on_silence with seek_step=1, keeping only
+    the previous chunk while silences are found.
+
+    Args:
+      inf: WAV file opened in binary mode
+      info: Tuple returned by wav_io.read_wav_info
+      min_silence_len: Minimum length of silences in milliseconds
+      silence_thresh: Level in dBFS below which audio counts as silent
+      keep_silence: Milliseconds of silence to keep either side of each chunk
+
+    Yields:
+      chunk: List of [start, end] chunk in milliseconds
+    """
+    audio_ms = len_ms(info[3], info[2])
+
+    def nonsilent_ranges():
+        found_silence = False
+        prev_end = 0
+        for start, end in detect_silence(inf, info, min_silence_len, silence_thresh):
+            if [start, end] == [0, audio_ms]:
+                return
+            if found_silence or start != 0:
+                yield [prev_end, start]
+            found_silence = True
+            prev_end = end
+        if not found_silence:
+            yield [0, audio_ms]
+        elif prev_end != audio_ms:
+            yield [prev_end, audio_ms]
+
+    prev_chunk = None
+    for start, end in nonsilent_ranges():
+        chunk = [start - keep_silence, end + keep_silence]
+        if prev_chunk is not None:
+            # split overlapping kept silence between neighbouring chunks
+            if chunk[0] < prev_chunk[1]:
+                prev_chunk[1] = (prev_chunk[1] + chunk[0]) // 2
+                chunk[0] = prev_chunk[1]
+            yield [max(prev_chunk[0], 0), min(prev_chunk[1], audio_ms)]
+        prev_chunk = chunk
+    if prev_chunk is not None:
+        yield [max(prev_chunk[0], 0), min(prev_chunk[1], audio_ms)]
+
 
 def split_audio(args):
-    audio_file, audio_out_dir = args
-    audio = AudioSegment.from_wav(audio_file)
+    audio_file, audio_out_dir, min_silence_len, keep_silence, silence_thresh = args
+    info = read_wav_info(audio_file)
+    nchannels, sampwidth, framerate, num_frames, _ = info
 
     audio_basename, _ = os.path.splitext(os.path.basename(audio_file))
     chunk_dir = os.path.join(audio_out_dir, audio_basename)
     os.makedirs(chunk_dir, exist_ok=True)
 
-    #print('Finding silences...')
-    chunks = split_on_silence(audio, min_silence_len=1500, keep_silence=500,
-                              silence_thresh=audio.dBFS - 16)
-    #for i, chunk in tqdm(enumerate(chunks, 1), 'Writing chunks', len(chunks)):
-    for i, chunk in enumerate(chunks, 1):
-        chunk_file = '{}_{:0>4d}.wav'.format(audio_basename, i)
-        chunk.export(os.path.join(chunk_dir, chunk_file), format='wav',
-                     parameters=['-ar', '16000', '-sample_fmt', 's16'])
+    with open(audio_file, 'rb') as inf:
+        silence_thresh += dbfs(total_energy(inf, info), num_frames * nchannels, sampwidth)
+        chunks = split_on_silence(inf, info, min_silence_len, silence_thresh, keep_silence)
+        for i, (start, end) in enumerate(chunks, 1):
+            # frames past the end of the audio are padded with silence, if
+            # rounding lengths in milliseconds overshoots
+            chunk = read_frames(inf, info, *ms_to_frames([start, end], framerate))
+            chunk_file = '{}_{:0>4d}.wav'.format(audio_basename, i)
+            write_wav(os.path.join(chunk_dir, chunk_file), chunk, nchannels, sampwidth, framerate)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('audio_in', help='Directory containing long input audio files')
+    parser.add_argument('audio_in', help='Directory containing long input audio files '
+                        '(16-bit PCM WAV, chunks are written in the same format)')
     parser.add_argument('audio_out', help='Directory to write output segmented audio')
     parser.add_argument('--nj', type=int, default=8, help='Number of parallel processes to run')
+    parser.add_argument('--min-silence-len', type=int, default=1500,
+        help='Minimum length of silences to split on, in milliseconds')
+    parser.add_argument('--keep-silence', type=int, default=500,
+        help='Milliseconds of silence to keep either side of each chunk')
+    parser.add_argument('--silence-thresh', type=float, default=-16,
+        help='Level below which audio counts as silent, in dB relative to each file')
     args = parser.parse_args()
 
     audio_files = sorted(glob(os.path.join(args.audio_in, '*.wav')))
     with Pool(args.nj) as pool:
         with tqdm(desc='Splitting audio', total=len(audio_files)) as pbar:
-            split_audio_args = zip(audio_files, repeat(args.audio_out))
+            split_audio_args = zip(audio_files, repeat(args.audio_out), repeat(args.min_silence_len),
+                                   repeat(args.keep_silence), repeat(args.silence_thresh))
             for _ in pool.imap(split_audio, split_audio_args):
                 pbar.update()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Read and write PCM WAV audio as NumPy arrays, memory-mapping source files.
+"""
+
+import os
+import wave
+
+import numpy as np
+
+
+_DTYPES = {1: 'u1', 2: '<i2', 4: '<i4'}
+
+
+def read_wav_info(wav_path):
+    """Read format and location of audio data from WAV file header
+
+    Args:
+      wav_path: Path to PCM WAV file
+
+    Returns:
+      nchannels: Number of channels
+      sampwidth: Bytes per sample
+      framerate: Sampling rate in Hz
+      num_frames: Number of frames of audio data
+      data_offset: Byte offset of audio data in file
+    """
+    with open(wav_path, 'rb') as inf:
+        with wave.open(inf) as wavf:
+            nchannels = wavf.getnchannels()
+            sampwidth = wavf.getsampwidth()
+            framerate = wavf.getframerate()
+            num_frames = wavf.getnframes()
+            # wave stops reading at the start of the data chunk
+            data_offset = inf.tell()
+        if sampwidth not in _DTYPES:
+            raise ValueError('{}: unsupported sample width {}'.format(wav_path, sampwidth))
+        # streamed WAVs may not have the real data size filled in
+        file_size = os.fstat(inf.fileno()).st_size
+        num_frames = min(num_frames, (file_size - data_offset) // (nchannels * sampwidth))
+    return nchannels, sampwidth, framerate, num_frames, data_offset
+
+
+def read_wav(wav_path):
+    """Memory-map audio samples in WAV file
+
+    Args:
+      wav_path: Path to PCM WAV file
+
+    Returns:
+      nchannels: Number of channels
+      sampwidth: Bytes per sample
+      framerate: Sampling rate in Hz
+      frames: Array of samples with shape (num_frames, nchannels), backed by
+        the file on disk so only the parts used are read into memory
+    """
+    nchannels, sampwidth, framerate, num_frames, data_offset = read_wav_info(wav_path)
+    if not num_frames:
+        frames = np.zeros((0, nchannels), dtype=_DTYPES[sampwidth])
+    else:
+        frames = np.memmap(wav_path, dtype=_DTYPES[sampwidth], mode='r',
+                           offset=data_offset, shape=(num_frames, nchannels))
+    return nchannels, sampwidth, framerate, frames
+
+
+def read_frames(inf, info, start, end):
+    """Read range of frames from open WAV file
+
+    Unlike slicing memory-mapped frames, this keeps no pages of the file
+    mapped afterwards, so scanning a long file doesn't grow memory use.
+
+    Args:
+      inf: WAV file opened in binary mode
+      info: Tuple returned by read_wav_info
+      start: Index of first frame
+      end: Index after last frame, past the end of the audio data to pad
+        with silence
+
+    Returns:
+      frames: Array of samples with shape (end - start, nchannels)
+    """
+    nchannels, sampwidth, _, num_frames, data_offset = info
+    frame_size = nchannels * sampwidth
+    frames = np.zeros((end - start, nchannels), dtype=_DTYPES[sampwidth])
+    if start < num_frames:
+        inf.seek(data_offset + start * frame_size)
+        data = inf.read((min(end, num_frames) - start) * frame_size)
+        frames[:len(data) // frame_size] = np.frombuffer(data, dtype=frames.dtype).reshape(-1, nchannels)
+    return frames
+
+
+def write_wav(wav_path, frames, nchannels, sampwidth, framerate):
+    """Write array of samples to WAV file
+
+    Args:
+      wav_path: Output path
+      frames: Array of samples with shape (num_frames, nchannels)
+      nchannels: Number of channels
+      sampwidth: Bytes per sample
+      framerate: Sampling rate in Hz
+    """
+    with wave.open(wav_path, 'wb') as wavf:
+        wavf.setnchannels(nchannels)
+        wavf.setsampwidth(sampwidth)
+        wavf.setframerate(framerate)
+        if len(frames):
+            wavf.writeframes(np.ascontiguousarray(frames))
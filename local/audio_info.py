@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Read audio durations from WAV and FLAC file headers without decoding.
+"""
+
+import argparse
+import os
+import struct
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def read_wav_header(inf):
+    """Parse RIFF chunks in WAV file up to the start of audio data
+
+    Args:
+      inf: WAV file opened in binary mode, positioned at start of file
+
+    Returns:
+      sample_rate: Sampling rate in Hz
+      channels: Number of channels
+      sample_width: Bytes per sample
+      data_offset: Byte offset of audio data in file
+      data_size: Size of audio data in bytes
+    """
+    riff = inf.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError("not a RIFF/WAVE file")
+    fmt = None
+    while True:
+        chunk = inf.read(8)
+        if len(chunk) < 8:
+            raise ValueError("no data chunk found")
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+        if chunk_id == b'fmt ':
+            fmt = inf.read(chunk_size)
+            if len(fmt) < 16:
+                raise ValueError("truncated fmt chunk")
+            if chunk_size % 2:
+                inf.seek(1, os.SEEK_CUR)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            channels, sample_rate, _, block_align, bits = struct.unpack('<HIIHH', fmt[2:16])
+            data_offset = inf.tell()
+            file_size = os.fstat(inf.fileno()).st_size
+            # streamed WAVs may not have the real data size filled in
+            if chunk_size in (0, 0xFFFFFFFF) or data_offset + chunk_size > file_size:
+                chunk_size = file_size - data_offset
+            if not channels or not sample_rate or not block_align:
+                raise ValueError("bad fmt chunk")
+            return sample_rate, channels, block_align // channels, data_offset, chunk_size
+        else:
+            inf.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+def read_flac_header(inf):
+    """Parse STREAMINFO block from FLAC file
+
+    Args:
+      inf: FLAC file opened in binary mode, positioned at start of file
+
+    Returns:
+      sample_rate: Sampling rate in Hz
+      channels: Number of channels
+      num_samples: Number of samples per channel
+    """
+    magic = inf.read(4)
+    if magic[:3] == b'ID3':
+        # skip ID3v2 tag, size is stored as a 28-bit syncsafe integer
+        header = magic + inf.read(6)
+        size = 0
+        for b in header[6:10]:
+            size = (size << 7) | (b & 0x7f)
+        inf.seek(10 + size)
+        magic = inf.read(4)
+    if magic != b'fLaC':
+        raise ValueError("not a FLAC file")
+    block = inf.read(4 + 34)
+    if len(block) < 38 or block[0] & 0x7f != 0:
+        raise ValueError("missing STREAMINFO block")
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1,
+    # 36 bits total samples
+    info, = struct.unpack('>Q', block[14:22])
+    sample_rate = info >> 44
+    channels = ((info >> 41) & 0x7) + 1
+    num_samples = info & 0xFFFFFFFFF
+    if not sample_rate or not num_samples:
+        raise ValueError("unknown sample rate or length in STREAMINFO")
+    return sample_rate, channels, num_samples
+
+
+def probe_audio(audio_path):
+    """Get audio sample rate and length from WAV or FLAC header
+
+    Args:
+      audio_path: Path to WAV or FLAC file
+
+    Returns:
+      sample_rate: Sampling rate in Hz
+      num_samples: Number of samples per channel
+
+    Raises:
+      OSError: If the file can't be read
+      ValueError: If the file header is invalid or the format unsupported
+    """
+    with open(audio_path, 'rb') as inf:
+        magic = inf.read(4)
+        inf.seek(0)
+        if magic == b'RIFF':
+            sample_rate, channels, sample_width, _, data_size = read_wav_header(inf)
+            num_samples = data_size // (channels * sample_width)
+        elif magic == b'fLaC' or magic[:3] == b'ID3':
+            sample_rate, _, num_samples = read_flac_header(inf)
+        else:
+            raise ValueError("unsupported audio format (only WAV and FLAC can be probed)")
+    if not num_samples:
+        raise ValueError("no audio data")
+    return sample_rate, num_samples
+
+
+def map_audio_files(func, items, num_threads=8, key=None):
+    """Apply function to audio files in a thread pool, keeping input order
+
+    Suits work which mostly waits on I/O or on subprocesses, like reading
+    headers or running sox. Only a few files per thread are read ahead, so
+    items can be a stream.
+
+    Args:
+      func: Function taking an audio path
+      items: Iterable over audio paths, or over anything else if key is given
+      num_threads: Number of threads
+      key: Function to get audio path from each item
+
+    Yields:
+      item: Input item
+      result: Return value of func, or the exception raised if it failed
+        with OSError or ValueError
+    """
+    def apply(audio_path):
+        try:
+            return func(audio_path)
+        except (OSError, ValueError, struct.error) as e:
+            return e
+
+    key = key or (lambda x: x)
+    pending = deque()
+    with ThreadPoolExecutor(num_threads) as executor:
+        for item in items:
+            pending.append((item, executor.submit(apply, key(item))))
+            if len(pending) >= 4 * num_threads:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def probe_audio_files(items, num_threads=8, key=None):
+    """Probe audio file headers in a thread pool, keeping input order
+
+    Args:
+      items: Iterable over audio paths, or over anything else if key is given
+      num_threads: Number of threads reading headers
+      key: Function to get audio path from each item
+
+    Yields:
+      item: Input item
+      info: Tuple of (sample_rate, num_samples) if the header could be read,
+        otherwise the exception raised
+    """
+    yield from map_audio_files(probe_audio, items, num_threads, key)
+
+
+def num_frames(num_samples, sample_rate, frame_length=0.025, frame_shift=0.01):
+    """Number of feature frames Kaldi extracts from audio, with --snip-edges=true
+
+    Args:
+      num_samples: Number of samples per channel
+      sample_rate: Sampling rate in Hz
+      frame_length: Frame length in seconds
+      frame_shift: Frame shift in seconds
+
+    Returns:
+      n_frames: Number of frames
+    """
+    window = int(sample_rate * frame_length)
+    shift = int(sample_rate * frame_shift)
+    if num_samples < window:
+        return 0
+    return 1 + (num_samples - window) // shift
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print durations of WAV and FLAC files read from headers")
+    parser.add_argument('audio', type=str, nargs='+',
+        help="Paths to audio files")
+    parser.add_argument('--num-threads', type=int, default=8,
+        help="Number of threads reading headers")
+    args = parser.parse_args()
+
+    status = 0
+    for audio_path, info in probe_audio_files(args.audio, args.num_threads):
+        if isinstance(info, Exception):
+            print("{}: {}".format(audio_path, info), file=sys.stderr)
+            status = 1
+        else:
+            sample_rate, num_samples = info
+            print("{} {:g}".format(audio_path, num_samples / sample_rate))
+    sys.exit(status)
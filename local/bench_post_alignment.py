@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark post-alignment Python stages on synthetic data.
+
+Generates a fake show-transitions dump, gzipped convert-ali outputs split
+across jobs, word- and phone-level CTMs and utt2dur for a given number of
+utterances, all consistent with each other. Each stage is then run as a
+subprocess, and wall time, peak RSS and output rate are reported as one JSON
+object per line. No Kaldi binaries are needed.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+LOCAL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# CMUdict-style phone set, silence is handled separately
+PHONES = ('AA AE AH AO AW AY B CH D DH EH ER EY F G HH IH IY JH K L M N NG OW '
+          'OY P R S SH T TH UH UW V W Y Z ZH').split()
+NUM_STATES = 3
+
+
+def make_transitions(trans_file):
+    """Write show-transitions style listing for 3-state phone HMMs
+
+    Args:
+      trans_file: Output file path
+
+    Returns:
+      trans_ids: Dict mapping phone labels (with word position tags) to
+        lists of (self_loop_id, forward_id) tuples per HMM state
+    """
+    labels = ['SIL'] + ['{}_{}'.format(p, pos) for p in PHONES for pos in 'BIES']
+    trans_ids = {}
+    trans_state = 1
+    trans_id = 1
+    with open(trans_file, 'w') as outf:
+        for label in labels:
+            trans_ids[label] = []
+            for state in range(NUM_STATES):
+                outf.write("Transition-state {}: phone = {} hmm-state = {} pdf = {}\n".format(
+                    trans_state, label, state, trans_state - 1))
+                outf.write(" Transition-id = {} p = 0.75 count of pdf = 100 [self-loop]\n".format(
+                    trans_id))
+                outf.write(" Transition-id = {} p = 0.25 count of pdf = 100 [{} -> {}]\n".format(
+                    trans_id + 1, state, state + 1))
+                trans_ids[label].append((trans_id, trans_id + 1))
+                trans_state += 1
+                trans_id += 2
+    return trans_ids
+
+
+def make_lexicon(rng, num_words=2000):
+    """Generate random words with pronunciations of 1-8 phones"""
+    lexicon = {}
+    while len(lexicon) < num_words:
+        pron = [rng.choice(PHONES) for _ in range(rng.randint(1, 8))]
+        lexicon['w{}'.format(len(lexicon))] = pron
+    return lexicon
+
+
+def position_tags(pron):
+    """Add Kaldi word position tags to a phone sequence"""
+    if len(pron) == 1:
+        return [pron[0] + '_S']
+    return [pron[0] + '_B'] + [p + '_I' for p in pron[1:-1]] + [pron[-1] + '_E']
+
+
+def make_utterance(rng, lexicon, words):
+    """Generate one utterance as a list of (word, [(phone, [frames per state])])"""
+    utt = [('<eps>', [('SIL', [rng.randint(1, 10) for _ in range(NUM_STATES)])])]
+    for i in range(rng.randint(3, 20)):
+        word = rng.choice(words)
+        phones = [(p, [rng.randint(1, 4) for _ in range(NUM_STATES)])
+                  for p in position_tags(lexicon[word])]
+        utt.append((word, phones))
+        if rng.random() < 0.2:
+            utt.append(('<eps>', [('SIL', [rng.randint(1, 10) for _ in range(NUM_STATES)])]))
+    utt.append(('<eps>', [('SIL', [rng.randint(1, 10) for _ in range(NUM_STATES)])]))
+    return utt
+
+
+def make_fixtures(fixture_dir, num_utts, nj, frame_shift=0.01, seed=0):
+    """Write consistent synthetic alignment data for all benchmarked stages
+
+    Args:
+      fixture_dir: Output directory
+      num_utts: Number of utterances to generate
+      nj: Number of alignment jobs to split convert-ali output across
+      frame_shift: Frame shift in seconds
+      seed: Random seed
+    """
+    rng = random.Random(seed)
+    os.makedirs(fixture_dir, exist_ok=True)
+    trans_ids = make_transitions(os.path.join(fixture_dir, 'transitions'))
+    lexicon = make_lexicon(rng)
+    words = sorted(lexicon)
+    ctm_line = "{} 1 {:.2f} {:.2f} {}\n"
+    utts_per_job = -(-num_utts // nj)
+    ali_gz = None
+    with open(os.path.join(fixture_dir, 'ctm'), 'w') as word_ctm, \
+            open(os.path.join(fixture_dir, 'ctm.phone'), 'w') as phone_ctm, \
+            open(os.path.join(fixture_dir, 'utt2dur'), 'w') as utt2dur:
+        for u in range(num_utts):
+            if u % utts_per_job == 0:
+                if ali_gz is not None:
+                    ali_gz.close()
+                job = u // utts_per_job + 1
+                ali_gz = gzip.open(os.path.join(fixture_dir, 'ali.trans.{}.gz'.format(job)),
+                                   'wt', compresslevel=1)
+            # zero-padded IDs so generation order matches Kaldi sort order
+            utt_id = 'spk{:04d}-utt{:07d}'.format(u // 50, u)
+            trans = []
+            frame = 0
+            for word, phones in make_utterance(rng, lexicon, words):
+                word_start = frame
+                for phone, state_frames in phones:
+                    phone_start = frame
+                    for state, n_frames in enumerate(state_frames):
+                        self_loop, forward = trans_ids[phone][state]
+                        trans.extend([self_loop] * (n_frames - 1) + [forward])
+                        frame += n_frames
+                    phone_ctm.write(ctm_line.format(utt_id, phone_start * frame_shift,
+                                                    (frame - phone_start) * frame_shift,
+                                                    phone))
+                word_ctm.write(ctm_line.format(utt_id, word_start * frame_shift,
+                                               (frame - word_start) * frame_shift, word))
+            ali_gz.write('{} {}\n'.format(utt_id, ' '.join(map(str, trans))))
+            utt2dur.write('{} {:.3f}\n'.format(utt_id, frame * frame_shift + 0.015))
+        ali_gz.close()
+    # make sure every job has an ali file, even if there are very few utterances
+    for job in range(1, nj + 1):
+        ali_file = os.path.join(fixture_dir, 'ali.trans.{}.gz'.format(job))
+        if not os.path.exists(ali_file):
+            gzip.open(ali_file, 'wt').close()
+
+
+def get_stages(fixture_dir, out_root, nj, variants):
+    """List benchmarked commands
+
+    Returns:
+      stages: List of (stage, variant, command, output_path) tuples
+    """
+    def script(name):
+        return [sys.executable, os.path.join(LOCAL_DIR, name)]
+
+    trans = os.path.join(fixture_dir, 'transitions')
+    ctm = os.path.join(fixture_dir, 'ctm')
+    ctm_phone = os.path.join(fixture_dir, 'ctm.phone')
+    stages = []
+    for variant, opts in [('default', []),
+                          ('numpy', ['--use-numpy']),
+                          ('parallel', ['--num-procs', str(nj)]),
+                          ('numpy_parallel_archive', ['--use-numpy', '--num-procs', str(nj),
+                                                      '--archive'])]:
+        out = os.path.join(out_root, 'phone_state_' + variant)
+        stages.append(('transitions_to_phone_ctm', variant,
+                       script('transitions_to_phone_ctm.py') + opts +
+                       ['--nj', str(nj), trans, fixture_dir, out], out))
+    for variant, opts in [('default', []), ('archive', ['--archive'])]:
+        out = os.path.join(out_root, 'split_ctm_' + variant)
+        stages.append(('split_ctm', variant,
+                       script('split_ctm.py') + opts + ['--strip-pos', ctm_phone, out], out))
+    out = os.path.join(out_root, 'text')
+    stages.append(('ctm_to_text', 'default',
+                   script('ctm_to_text.py') + ['--strip-pos', ctm_phone, out], out))
+    for variant, opts in [('default', []), ('parallel', ['--nj', str(nj)])]:
+        out = os.path.join(out_root, 'textgrid_' + variant)
+        stages.append(('ctm_to_textgrid', variant,
+                       script('ctm_to_textgrid.py') + opts +
+                       ['--strip-pos', '--datadir', fixture_dir, ctm, ctm_phone, out], out))
+    if variants:
+        stages = [s for s in stages if s[0] in variants or '{}:{}'.format(*s[:2]) in variants]
+    return stages
+
+
+def count_outputs(out_path):
+    """Count output files, or utterances in an output archive or text file"""
+    if os.path.isfile(out_path):
+        with open(out_path, 'rb') as inf:
+            return sum(1 for _ in inf)
+    archive_index = os.path.join(out_path, 'ctm.idx')
+    if os.path.exists(archive_index):
+        with open(archive_index, 'rb') as inf:
+            return sum(1 for _ in inf)
+    return len(os.listdir(out_path))
+
+
+def run_stage(cmd):
+    """Run command, measuring wall time and peak RSS
+
+    Returns:
+      wall_time: Elapsed time in seconds
+      peak_rss: Peak resident set size in MB, of the largest single process
+        among the command and any worker processes it waited for
+      returncode: Exit status
+    """
+    # stderr goes to a file rather than a pipe, so chatty stages can't block
+    # on a full pipe buffer while we wait for them to exit
+    with tempfile.TemporaryFile() as errf:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=errf)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_time = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            errf.seek(0)
+            sys.stderr.write(errf.read().decode(errors='replace'))
+    # ru_maxrss is in kilobytes on Linux
+    return wall_time, rusage.ru_maxrss / 1024, proc.returncode
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark post-alignment Python stages on synthetic data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-utts', type=int, nargs='+', default=[10000],
+        help="Corpus sizes to benchmark, in utterances")
+    parser.add_argument('--nj', type=int, default=4,
+        help="Number of alignment jobs to simulate, and parallel processes "
+        "for stages that support them")
+    parser.add_argument('--stages', type=str, nargs='*', default=[],
+        help="Only run these stages, either by script name (e.g. split_ctm) or "
+        "as stage:variant (e.g. ctm_to_textgrid:parallel)")
+    parser.add_argument('--workdir', type=str, default=None,
+        help="Directory for synthetic data and outputs (default: temporary "
+        "directory, deleted afterwards)")
+    parser.add_argument('--output', type=str, default='-',
+        help="File to write JSON results, one line per stage ('-' for stdout)")
+    parser.add_argument('--seed', type=int, default=0,
+        help="Random seed for synthetic data")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_post_alignment.')
+    outf = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        for num_utts in args.num_utts:
+            fixture_dir = os.path.join(workdir, 'utts{}'.format(num_utts))
+            start = time.perf_counter()
+            make_fixtures(fixture_dir, num_utts, args.nj, seed=args.seed)
+            print("Generated {} synthetic utterances in {:.1f}s: {}".format(
+                num_utts, time.perf_counter() - start, fixture_dir), file=sys.stderr)
+            out_root = os.path.join(fixture_dir, 'out')
+            for stage, variant, cmd, out_path in get_stages(fixture_dir, out_root, args.nj,
+                                                            args.stages):
+                wall_time, peak_rss, returncode = run_stage(cmd)
+                n_outputs = count_outputs(out_path) if returncode == 0 else 0
+                result = {
+                    'stage': stage,
+                    'variant': variant,
+                    'num_utts': num_utts,
+                    'wall_time_s': round(wall_time, 3),
+                    'peak_rss_mb': round(peak_rss, 1),
+                    'outputs': n_outputs,
+                    'outputs_per_s': round(n_outputs / wall_time, 1),
+                    'returncode': returncode,
+                }
+                outf.write(json.dumps(result) + '\n')
+                outf.flush()
+    finally:
+        if outf is not sys.stdout:
+            outf.close()
+        if args.workdir is None:
+            shutil.rmtree(workdir)
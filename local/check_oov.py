@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import argparse
-import locale
+import math
 import os
+import random
+import shutil
 import sys
-from collections import defaultdict
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
 
 
 def load_words(words_file, enc='utf-8'):
@@ -14,32 +18,67 @@ def load_words(words_file, enc='utf-8'):
       words_file: Path to Kaldi `words.txt` data file
 
     Returns:
-      words: Set of known words
+      words: Frozen set of known words
     """
-    words = set()
     with open(words_file, encoding=enc) as inf:
-        for line in inf:
-            words.add(line.strip().split()[0])
-    return words
+        return frozenset(line.split(maxsplit=1)[0] for line in inf if line.strip())
 
 
-def check_oov(text_file, words, enc='utf-8'):
-    """Find utterances with out-of-vocabulary items in transcripts
+def shard_text(text_file, num_shards):
+    """Split file into byte ranges starting and ending on line boundaries
+
+    Args:
+      text_file: Path to text file
+      num_shards: Maximum number of shards
+
+    Returns:
+      shards: List of (start, end) byte offsets covering the whole file
+    """
+    size = os.path.getsize(text_file)
+    offsets = [0]
+    with open(text_file, 'rb') as inf:
+        for i in range(1, num_shards):
+            inf.seek(max(size * i // num_shards, offsets[-1]))
+            if inf.tell() > 0:
+                # skip to start of next line, unless already at one
+                inf.seek(-1, os.SEEK_CUR)
+                inf.readline()
+            if offsets[-1] < inf.tell() < size:
+                offsets.append(inf.tell())
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def check_oov_shard(text_file, start, end, words, oov_utts_file, enc='utf-8',
+                    max_oov_utts=0):
+    """Find utterances with out-of-vocabulary items in part of a transcript file
 
     Args:
       text_file: Path to Kaldi `text` data file
+      start: Byte offset of first line in shard
+      end: Byte offset after last line in shard
       words: Set of known words
+      oov_utts_file: Path to write utterances with OOV items, with OOV items
+        marked up: "this is an OOV_unknown word"
+      enc: File encoding for input/output text
+      max_oov_utts: Stop after finding this many utterances with OOV items
+        (0 to check all lines)
 
     Returns:
-      oov_utts: Dict mapping utterance IDs to tuples like (transcript, oov_count),
-        where transcripts have OOV items marked up: "this is an OOV_unknown word"
+      n_oov_utts: Number of utterances with OOV items
       oov_words: Dict mapping OOV words to count across transcripts
+      stopped: Whether max_oov_utts was reached with lines left in the shard
     """
-    oov_utts = {}
-    oov_words = defaultdict(int)
-    with open(text_file, encoding=enc) as inf:
+    n_oov_utts = 0
+    oov_words = Counter()
+    with open(text_file, 'rb') as inf, open(oov_utts_file, 'w', encoding=enc) as outf:
+        inf.seek(start)
+        pos = start
         for line in inf:
-            utt_id, *text = line.strip().split()
+            if pos >= end:
+                break
+            pos += len(line)
+            utt_id, *text = line.decode(enc).split()
             oov_count = 0
             for i, word in enumerate(text):
                 if word not in words:
@@ -47,28 +86,168 @@ def check_oov(text_file, words, enc='utf-8'):
                     text[i] = "OOV_{}".format(word)
                     oov_count += 1
             if oov_count:
-                oov_utts[utt_id] = (' '.join(text), oov_count)
-    return oov_utts, dict(oov_words)
+                outf.write("{} {}\n".format(utt_id, ' '.join(text)))
+                n_oov_utts += 1
+                if n_oov_utts == max_oov_utts:
+                    break
+    return n_oov_utts, oov_words, pos < end
+
+
+_words = None
 
 
-def write_oov_utts(oov_utts, outfile, enc='utf-8'):
-    """Write listing of utterances containing OOV items to file
+def _init_worker(words):
+    global _words
+    _words = words
+
+
+def _check_oov_shard(args):
+    text_file, start, end, oov_utts_file, enc, max_oov_utts = args
+    return check_oov_shard(text_file, start, end, _words, oov_utts_file, enc, max_oov_utts)
+
+
+def check_oov_sharded(text_file, words, oov_utts_file, num_procs=1, enc='utf-8',
+                      max_oov_utts=0):
+    """Find utterances with OOV items, splitting transcripts across processes
+
+    The text file is split into byte ranges on line boundaries. Each worker
+    writes OOV utterances for its shards to a separate file, and these are
+    appended to the output in order as they finish, so the output is the same
+    as checking the whole file in one process. The vocabulary is only passed
+    to each worker once, when it starts.
 
     Args:
-      oov_utts: Dict mapping utterance IDs to tuples like (transcript, oov_count),
-        where transcripts have OOV items marked up: "this is an <UNKNOWN> word"
-      outfile: Output file path
+      text_file: Path to Kaldi `text` data file
+      words: Set of known words
+      oov_utts_file: Path to write utterances with OOV items, removed if there
+        are none
+      num_procs: Number of worker processes
+      enc: File encoding for input/output text
+      max_oov_utts: Stop after finding this many utterances with OOV items,
+        in file order (0 to check all lines)
+
+    Returns:
+      n_oov_utts: Number of utterances with OOV items
+      oov_words: Dict mapping OOV words to count across transcripts
+      stopped: Whether max_oov_utts was reached before the end of the file
     """
-    # sort as LC_ALL=C for compatibility with Kaldi sorting
-    locale.setlocale(locale.LC_ALL, 'C')
-    if oov_utts:
-        with open(outfile, 'w', encoding=enc) as outf:
-            oov_total = 0
-            for utt, (text, oov_count) in oov_utts.items():
-                outf.write("{} {}\n".format(utt, text))
-                oov_total += oov_count
-        print("Found {} out-of-vocabulary items across {} utterances".format(
-            oov_total, len(oov_utts)))
+    # a few shards per worker to balance load
+    shards = shard_text(text_file, 4 * num_procs if num_procs > 1 else 1)
+    shard_args = [(text_file, start, end, '{}.{}'.format(oov_utts_file, i), enc, max_oov_utts)
+                  for i, (start, end) in enumerate(shards)]
+    n_oov_utts = 0
+    oov_words = Counter()
+    stopped = False
+    with open(oov_utts_file, 'wb') as outf:
+        if num_procs > 1:
+            pool = Pool(num_procs, _init_worker, (words,))
+            results = pool.imap(_check_oov_shard, shard_args)
+        else:
+            pool = None
+            results = (check_oov_shard(*args[:3], words, *args[3:]) for args in shard_args)
+        try:
+            for i, (args, (shard_oov_utts, shard_oov_words, shard_stopped)) in enumerate(
+                    zip(shard_args, results)):
+                if max_oov_utts and n_oov_utts + shard_oov_utts > max_oov_utts:
+                    # only need the first few from this shard, check again so
+                    # that counts match the utterances we keep
+                    args = args[:-1] + (max_oov_utts - n_oov_utts,)
+                    shard_oov_utts, shard_oov_words, shard_stopped = check_oov_shard(
+                        *args[:3], words, *args[3:])
+                n_oov_utts += shard_oov_utts
+                oov_words.update(shard_oov_words)
+                shard_file = args[3]
+                with open(shard_file, 'rb') as inf:
+                    shutil.copyfileobj(inf, outf)
+                os.remove(shard_file)
+                if max_oov_utts and n_oov_utts >= max_oov_utts:
+                    stopped = shard_stopped or i < len(shard_args) - 1
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            for args in shard_args:
+                if os.path.exists(args[3]):
+                    os.remove(args[3])
+    if not n_oov_utts:
+        os.remove(oov_utts_file)
+    return n_oov_utts, dict(oov_words), stopped
+
+
+def count_lines(inf):
+    """Count lines in file opened in binary mode, from the current position"""
+    n_lines = 0
+    last = b'\n'
+    for block in iter(lambda: inf.read(1 << 20), b''):
+        n_lines += block.count(b'\n')
+        last = block[-1:]
+    # last line may not end with a newline
+    return n_lines + (last != b'\n')
+
+
+def sample_oov(text_file, words, num_samples, enc='utf-8', seed=0):
+    """Check a random sample of transcripts for out-of-vocabulary items
+
+    Lines are counted in a first pass, then line numbers are drawn uniformly
+    with replacement and the sampled lines read in a second pass, skipping
+    over the others without decoding them.
+
+    Args:
+      text_file: Path to Kaldi `text` data file
+      words: Set of known words
+      num_samples: Number of lines to sample
+      enc: File encoding for input text
+      seed: Random seed
+
+    Returns:
+      n_oov_utts: Number of sampled utterances with OOV items
+      n_tokens: Number of tokens in sampled utterances
+      oov_words: Dict mapping OOV words to count across sampled utterances
+    """
+    rng = random.Random(seed)
+    n_oov_utts = 0
+    n_tokens = 0
+    oov_words = Counter()
+    with open(text_file, 'rb') as inf:
+        n_lines = count_lines(inf)
+        if not n_lines:
+            return 0, 0, {}
+        inf.seek(0)
+        next_line = 0
+        for line_no in sorted(rng.randrange(n_lines) for _ in range(num_samples)):
+            # the same line may be sampled more than once
+            if line_no >= next_line:
+                line = next(islice(inf, line_no - next_line, None))
+                next_line = line_no + 1
+            text = line.decode(enc).split()[1:]
+            n_tokens += len(text)
+            oovs = [word for word in text if word not in words]
+            if oovs:
+                n_oov_utts += 1
+                oov_words.update(oovs)
+    return n_oov_utts, n_tokens, dict(oov_words)
+
+
+def wilson_interval(successes, n, z=1.96):
+    """Wilson score confidence interval for a binomial proportion
+
+    Args:
+      successes: Number of successes
+      n: Number of trials
+      z: Standard normal quantile for the confidence level (1.96 for 95%)
+
+    Returns:
+      low: Lower bound
+      high: Upper bound
+    """
+    if not n:
+        return 0.0, 1.0
+    p = successes / n
+    denom = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denom
+    half_width = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denom
+    return max(0.0, center - half_width), min(1.0, center + half_width)
 
 
 def write_oov_words(oov_words, outfile, enc='utf-8'):
@@ -100,13 +279,45 @@ if __name__ == '__main__':
         help="Working directory for alignment")
     parser.add_argument('--file-enc', type=str, default='utf-8',
         help="File encoding for input/output text")
+    parser.add_argument('--num-procs', type=int, default=1,
+        help="Number of parallel processes checking transcripts")
+    parser.add_argument('--max-oov-utts', type=int, default=0,
+        help="Stop after finding this many utterances with OOV items (0 to "
+        "check all transcripts)")
+    parser.add_argument('--sample', type=int, default=0,
+        help="Only check this many randomly sampled transcripts and estimate "
+        "OOV rates, without writing OOV files")
+    parser.add_argument('--top-oovs', type=int, default=10,
+        help="Number of most frequent OOV items to report when sampling")
+    parser.add_argument('--seed', type=int, default=0,
+        help="Random seed for sampling transcripts")
     args = parser.parse_args()
 
     words = load_words(args.words, args.file_enc)
-    oov_utts, oov_words = check_oov(args.text, words, args.file_enc)
-
-    write_oov_utts(oov_utts, os.path.join(args.workdir, 'oov_utts.txt'), args.file_enc)
-    write_oov_words(oov_words, os.path.join(args.workdir, 'oov_words.txt'), args.file_enc)
+    if args.sample:
+        n_oov_utts, n_tokens, oov_words = sample_oov(
+            args.text, words, args.sample, args.file_enc, args.seed)
+        low, high = wilson_interval(n_oov_utts, args.sample)
+        print("Sampled {} utterances, {} with out-of-vocabulary items".format(
+            args.sample, n_oov_utts))
+        print("Estimated OOV utterance rate: {:.2%} (95% CI {:.2%} - {:.2%})".format(
+            n_oov_utts / args.sample, low, high))
+        print("OOV token rate in sample: {:.2%}".format(
+            sum(oov_words.values()) / n_tokens if n_tokens else 0))
+        if oov_words:
+            print("Most frequent OOV items in sample:")
+            for word, count in sorted(oov_words.items(), key=lambda x: x[1],
+                                      reverse=True)[:args.top_oovs]:
+                print("  {} {}".format(word, count))
+    else:
+        n_oov_utts, oov_words, stopped = check_oov_sharded(
+            args.text, words, os.path.join(args.workdir, 'oov_utts.txt'), args.num_procs,
+            args.file_enc, args.max_oov_utts)
+        if n_oov_utts:
+            print("Found {} out-of-vocabulary items across {} utterances{}".format(
+                sum(oov_words.values()), n_oov_utts,
+                " (stopped early)" if stopped else ""))
+        write_oov_words(oov_words, os.path.join(args.workdir, 'oov_words.txt'), args.file_enc)
 
     # non-zero exit to abort aligner run
     if oov_words and args.warn_on_oov:
@@ -4,8 +4,13 @@
 Utilities for working with GlobalPhone pronunciation dictionaries.
 """
 
+import hashlib
+import os
+import pickle
 import re
+import tempfile
 from collections import defaultdict, OrderedDict
+from multiprocessing import Pool
 
 
 # NB. These encodings are correct for the versions of GlobalPhone dictionaries
@@ -58,10 +63,17 @@ _re_tone = re.compile(r'(T\d)')
 # Tags for variant pronunciations
 _re_pronvar = re.compile(r'\(\d\)$')
 
+# Symbols found in pronunciations which are not counted in phone sets
+_NON_PHONES = {'SIL', 'WB', '+QK', '+hGH'}
+
+# Bump this whenever lexicon cleaning or phone mappings change, so that
+# previously cached lexicons are not reused
+_CACHE_VERSION = 1
+
 
 class GlobalPhoneLex():
     def __init__(self, lex_file, lang_code, keep_wb=False, keep_tone=False,
-                 keep_length=False, map_ipa=True):
+                 keep_length=False, map_ipa=True, cache_dir=None):
         self.lex_file = lex_file
         self.lang_code = lang_code
         self.encoding = _ENCODINGS[lang_code]
@@ -69,12 +81,19 @@ class GlobalPhoneLex():
         self.keep_wb = keep_wb
         self.keep_tone = keep_tone
         self.keep_length = keep_length
+        self.map_ipa = map_ipa
         self.tag_order = ['WB', 'T', 'L']
 
-        self.lex, self.phone_set = self.load_lex()
-        if map_ipa:
-            self.ipa_phone_map = self.get_ipa_phone_map()
-            self.ipa_phone_set = self.get_ipa_phone_set()
+        # cleaned lexicon and phone mappings can be cached to skip parsing
+        # the same dictionary with the same options again
+        cache_file = self.cache_path(cache_dir) if cache_dir else None
+        if cache_file is None or not self.load_cache(cache_file):
+            self.lex, self.phone_set = self.load_lex()
+            if map_ipa:
+                self.ipa_phone_map = self.get_ipa_phone_map()
+                self.ipa_phone_set = self.get_ipa_phone_set()
+            if cache_file is not None:
+                self.save_cache(cache_file)
 
     # TODO: inherit from collections.UserDict or
     #       collections.abc.[Mutable]Mapping instead?
@@ -86,7 +105,6 @@ class GlobalPhoneLex():
         # (e.g. might be based on frequency), but remove duplicates
         lex = defaultdict(OrderedDict)
         phone_set = set()
-        non_phones = {'SIL', 'WB', '+QK', '+hGH'}
         with open(self.lex_file, encoding=self.encoding) as inf:
             for entry in inf:
                 # TODO: check if there are ever spaces in dictionary keys
@@ -96,20 +114,66 @@ class GlobalPhoneLex():
                 pronstr = self.clean_pronstr(pronstr)
                 lex[key][pronstr] = None
                 phone_set.update(pronstr.split())
-        phone_set = phone_set.difference(non_phones)
+        phone_set = phone_set.difference(_NON_PHONES)
         # list of deduplicated prons per word, with original order intact
         lex = {i: list(j.keys()) for i, j in lex.items()}
         return lex, phone_set
 
+    def cache_path(self, cache_dir):
+        """Get cache file path keyed by dictionary contents and options"""
+        key = hashlib.sha1()
+        with open(self.lex_file, 'rb') as inf:
+            for block in iter(lambda: inf.read(1 << 20), b''):
+                key.update(block)
+        key.update(repr((_CACHE_VERSION, self.lang_code, self.keep_wb, self.keep_tone,
+                         self.keep_length, self.map_ipa)).encode())
+        return os.path.join(cache_dir, '{}.{}.pkl'.format(self.lang_code, key.hexdigest()))
+
+    def load_cache(self, cache_file):
+        """Load cleaned lexicon and phone mappings, if cached
+
+        Returns:
+          True if the cache could be loaded, otherwise False
+        """
+        try:
+            with open(cache_file, 'rb') as inf:
+                cached = pickle.load(inf)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        self.lex = cached['lex']
+        self.phone_set = cached['phone_set']
+        if self.map_ipa:
+            self.ipa_phone_map = cached['ipa_phone_map']
+            self.ipa_phone_set = cached['ipa_phone_set']
+        return True
+
+    def save_cache(self, cache_file):
+        """Save cleaned lexicon and phone mappings for later loads"""
+        cached = {'lex': self.lex, 'phone_set': self.phone_set}
+        if self.map_ipa:
+            cached['ipa_phone_map'] = self.ipa_phone_map
+            cached['ipa_phone_set'] = self.ipa_phone_set
+        cache_dir = os.path.dirname(cache_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to temporary file first so concurrent loads never see
+        # partial output
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as outf:
+                pickle.dump(cached, outf, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
     def write_lex(self, path, phone_map=False):
+        if phone_map:
+            entries = self.map_lex(phone_map)
+        else:
+            entries = self.lex.items()
         with open(path, 'w', encoding='utf-8') as outf:
-            for word in self.lex:
-                if phone_map:
-                    prons = self.map_prons(word, phone_map)
-                else:
-                    prons = self.lex[word]
-                for pron in prons:
-                    outf.write('{} {}\n'.format(word, pron))
+            for word, prons in entries:
+                outf.writelines(['{} {}\n'.format(word, pron) for pron in prons])
 
     def clean_pronstr(self, pronstr):
         phones = []
@@ -192,6 +256,45 @@ class GlobalPhoneLex():
             ipa_prons.append(ipa_pron)
         return ipa_prons
 
+    def get_phone_table(self, phone_map='ipa'):
+        """Precompute mapped phone sequences for all phones in lexicon
+
+        Phones missing from the mapping are kept as they are, and phones
+        mapped to empty strings are suppressed.
+
+        Args:
+          phone_map: 'ipa' or 'gp' to map to those phone sets, anything
+            else to keep original phones
+
+        Returns:
+          phone_table: Dict mapping phones to lists of output phones
+        """
+        if phone_map == 'ipa':
+            phone_map = self.ipa_phone_map
+        elif phone_map == 'gp':
+            phone_map = lang2gp[self.lang_code]
+        else:
+            phone_map = {}
+        return {phone: phone_map.get(phone, phone).split()
+                for phone in self.phone_set.union(_NON_PHONES)}
+
+    def map_lex(self, phone_map='ipa'):
+        """Map pronunciations for all words in lexicon in one pass
+
+        Args:
+          phone_map: 'ipa' or 'gp' to map to those phone sets, anything
+            else to keep original phones
+
+        Yields:
+          word: Word
+          mapped_prons: List of mapped pronunciations
+        """
+        phone_table = self.get_phone_table(phone_map)
+        for word, prons in self.lex.items():
+            yield word, [' '.join([mapped_phone for phone in pron.split()
+                                   for mapped_phone in phone_table[phone]])
+                         for pron in prons]
+
     def map_prons(self, word, phone_map='ipa'):
         if phone_map == 'ipa':
             phone_map = self.ipa_phone_map
@@ -214,6 +317,32 @@ class GlobalPhoneLex():
         return mapped_prons
 
 
+def _export_lex(job):
+    lex_in, lang_code, lex_out, phone_map, options = job
+    lex = GlobalPhoneLex(lex_in, lang_code, map_ipa=(phone_map == 'ipa'), **options)
+    lex.write_lex(lex_out, phone_map=phone_map)
+    return lex_out
+
+
+def export_lexicons(jobs, phone_map=None, num_procs=4, **options):
+    """Convert several GlobalPhone dictionaries in parallel
+
+    Args:
+      jobs: Iterable over tuples of (input dictionary path, language code,
+        output lexicon path)
+      phone_map: 'ipa' or 'gp' to map to those phone sets, None to keep
+        original phones
+      num_procs: Number of worker processes
+      options: Other keyword arguments to GlobalPhoneLex, e.g. keep_tone
+
+    Yields:
+      lex_out: Path to each output lexicon, as it is completed
+    """
+    jobs = [(*job, phone_map, options) for job in jobs]
+    with Pool(min(num_procs, len(jobs)) or 1) as pool:
+        yield from pool.imap_unordered(_export_lex, jobs)
+
+
 # Phone set mappings
 
 # IPA compatible with panphon
@@ -2,19 +2,36 @@
 
 import argparse
 
-from globalphone import GlobalPhoneLex
+from globalphone import GlobalPhoneLex, export_lexicons
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Convert GlobalPhone pronunciation dictionaries to Kaldi-friendly format')
-    parser.add_argument('lex_in', type=str, help='Path to GlobalPhone pronunciation dictionary')
-    parser.add_argument('lang', type=str, help='GlobalPhone language code')
-    parser.add_argument('lex_out', type=str, help='Path to write output lexicon')
+    parser.add_argument('lex_in', type=str, nargs='?', help='Path to GlobalPhone pronunciation dictionary')
+    parser.add_argument('lang', type=str, nargs='?', help='GlobalPhone language code')
+    parser.add_argument('lex_out', type=str, nargs='?', help='Path to write output lexicon')
     parser.add_argument('--phone_set', type=str, choices=['gp', 'ipa'], default=None,
         help='Map language-specific phone sets to GlobalPhone or IPA symbols')
     parser.add_argument('--keep-tone', action='store_true', help='Keep tone tags')
     parser.add_argument('--keep-length', action='store_true', help='Keep length tags')
+    parser.add_argument('--cache-dir', type=str, default=None,
+        help='Directory to cache cleaned dictionaries, to load them faster next time')
+    parser.add_argument('--batch', type=str, default=None,
+        help='File listing several dictionaries to convert instead, with lines like '
+        '<lex_in> <lang> <lex_out>')
+    parser.add_argument('--nj', type=int, default=4,
+        help='Number of dictionaries to convert in parallel with --batch')
     args = parser.parse_args()
 
-    lex = GlobalPhoneLex(args.lex_in, args.lang, keep_tone=args.keep_tone, keep_length=args.keep_length)
-    lex.write_lex(args.lex_out, phone_map=args.phone_set)
+    if args.batch:
+        with open(args.batch) as inf:
+            jobs = [line.split() for line in inf if line.strip()]
+        for lex_out in export_lexicons(jobs, args.phone_set, args.nj, keep_tone=args.keep_tone,
+                                       keep_length=args.keep_length, cache_dir=args.cache_dir):
+            print('Wrote {}'.format(lex_out))
+    elif None in (args.lex_in, args.lang, args.lex_out):
+        parser.error('lex_in, lang and lex_out are required unless using --batch')
+    else:
+        lex = GlobalPhoneLex(args.lex_in, args.lang, keep_tone=args.keep_tone, keep_length=args.keep_length,
+                             cache_dir=args.cache_dir)
+        lex.write_lex(args.lex_out, phone_map=args.phone_set)
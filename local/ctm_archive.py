@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""
+Utilities for working with indexed CTM archives.
+
+An archive is a single multi-utterance CTM file in which each utterance's
+lines form one contiguous block, stored alongside an index file listing the
+byte offset and length of every block:
+
+    <utterance-id> <offset> <length>
+
+The data file is still a valid Kaldi CTM, so anything reading multi-utterance
+CTMs can use it directly, while the index gives random access by utterance ID
+without one file per utterance on disk. Conversely, any Kaldi CTM sorted by
+utterance ID (e.g. ctm or ctm.phone from alignment) can be indexed in a single
+pass and then read like an archive.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+
+INDEX_SUFFIX = '.idx'
+
+
+def index_path(ctm_file):
+    """Path to the index file stored alongside a CTM archive"""
+    return ctm_file + INDEX_SUFFIX
+
+
+def load_index(index_file):
+    """Load CTM archive index
+
+    Args:
+      index_file: Path to index file listing utterance IDs with byte offsets
+        and lengths of their blocks in the archive
+
+    Returns:
+      index: Dict mapping utterance IDs to (offset, length) tuples, in
+        archive order
+    """
+    index = {}
+    with open(index_file, encoding='utf-8') as inf:
+        for line in inf:
+            utt, offset, length = line.split()
+            index[utt] = (int(offset), int(length))
+    return index
+
+
+def index_ctm(ctm_file, enc='utf-8'):
+    """Index contiguous per-utterance blocks in a multi-utterance CTM file
+
+    Args:
+      ctm_file: Path to CTM file, with all lines for each utterance together
+      enc: File encoding for CTM text
+
+    Returns:
+      index: Dict mapping utterance IDs to (offset, length) tuples, in
+        file order
+    """
+    index = {}
+    prev_utt = None
+    block_start = 0
+    offset = 0
+    with open(ctm_file, 'rb') as inf:
+        for line in inf:
+            fields = line.split(maxsplit=1)
+            if fields:
+                utt = fields[0].decode(enc)
+                if utt != prev_utt:
+                    if prev_utt is not None:
+                        index[prev_utt] = (block_start, offset - block_start)
+                    if utt in index:
+                        raise ValueError("Lines for utterance {} are not contiguous "
+                                         "in {}".format(utt, ctm_file))
+                    prev_utt = utt
+                    block_start = offset
+            offset += len(line)
+    if prev_utt is not None:
+        index[prev_utt] = (block_start, offset - block_start)
+    return index
+
+
+def get_index(ctm_file, enc='utf-8'):
+    """Load index for CTM file, building and saving it first if needed
+
+    An existing index is reused unless the CTM file has been modified since
+    it was written.
+
+    Args:
+      ctm_file: Path to multi-utterance CTM file
+      enc: File encoding for CTM text
+
+    Returns:
+      index: Dict mapping utterance IDs to (offset, length) tuples
+    """
+    index_file = index_path(ctm_file)
+    if (os.path.exists(index_file)
+            and os.path.getmtime(index_file) >= os.path.getmtime(ctm_file)):
+        return load_index(index_file)
+    index = index_ctm(ctm_file, enc)
+    write_index(index, index_file)
+    return index
+
+
+def write_index(index, index_file):
+    """Write CTM archive index
+
+    Args:
+      index: Dict mapping utterance IDs to (offset, length) tuples
+      index_file: Output file path
+    """
+    with open(index_file, 'w', encoding='utf-8') as outf:
+        for utt, (offset, length) in index.items():
+            outf.write("{} {} {}\n".format(utt, offset, length))
+
+
+class CtmArchiveWriter():
+    """Write per-utterance CTM blocks to a single indexed archive
+
+    Args:
+      ctm_file: Path to output archive, index is written to ctm_file + '.idx'
+      enc: File encoding for CTM text
+    """
+    def __init__(self, ctm_file, enc='utf-8'):
+        self.ctm_file = ctm_file
+        self.enc = enc
+        self.offset = 0
+        self._data = open(ctm_file, 'wb')
+        self._index = open(index_path(ctm_file), 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, utt, lines):
+        """Append CTM lines for one utterance to the archive"""
+        block = ''.join(lines).encode(self.enc)
+        self._data.write(block)
+        self._index.write("{} {} {}\n".format(utt, self.offset, len(block)))
+        self.offset += len(block)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+
+class CtmArchive():
+    """Random access to per-utterance CTM blocks in an indexed archive
+
+    Behaves like a read-only dict mapping utterance IDs to the CTM lines for
+    that utterance. Plain multi-utterance CTM files are indexed on first use.
+
+    Args:
+      ctm_file: Path to CTM archive, with index at ctm_file + '.idx'
+      enc: File encoding for CTM text
+    """
+    def __init__(self, ctm_file, enc='utf-8'):
+        self.ctm_file = ctm_file
+        self.enc = enc
+        self.index = get_index(ctm_file, enc)
+        self._data = open(ctm_file, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, utt):
+        offset, length = self.index[utt]
+        self._data.seek(offset)
+        return self._data.read(length).decode(self.enc).splitlines(keepends=True)
+
+    def __contains__(self, utt):
+        return utt in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def items(self):
+        for utt in self.index:
+            yield utt, self[utt]
+
+    def close(self):
+        self._data.close()
+
+
+def read_ctm_lines(ctm_file, utts=None, enc='utf-8'):
+    """Iterate over lines of a multi-utterance CTM file
+
+    Args:
+      ctm_file: Path to multi-utterance CTM file
+      utts: Optional collection of utterance IDs to read. If given, we seek
+        directly to the blocks for these utterances using the CTM index,
+        which is built on first use
+      enc: File encoding for CTM text
+
+    Yields:
+      line: CTM lines, in file order
+    """
+    if utts is None:
+        with open(ctm_file, encoding=enc) as inf:
+            yield from inf
+        return
+    utts = set(utts)
+    with CtmArchive(ctm_file, enc) as archive:
+        for utt in archive:
+            if utt in utts:
+                yield from archive[utt]
+
+
+def load_utt_list(utt_list):
+    """Load utterance IDs from the first field of each line in a file
+
+    Works for plain lists as well as Kaldi data files like text, or the
+    retried_alignment.txt and failed_to_align.txt files from alignment.
+    """
+    utts = []
+    with open(utt_list, encoding='utf-8') as inf:
+        for line in inf:
+            fields = line.split(maxsplit=1)
+            if fields:
+                utts.append(fields[0])
+    return utts
+
+
+def concat_archives(ctm_files, out_file, remove=True):
+    """Concatenate CTM archives into one, shifting index offsets to match
+
+    Args:
+      ctm_files: Paths to input archives, in output order
+      out_file: Path to write combined archive
+      remove: Delete input archives once copied
+    """
+    index = {}
+    offset = 0
+    with open(out_file, 'wb') as outf:
+        for ctm_file in ctm_files:
+            for utt, (start, length) in load_index(index_path(ctm_file)).items():
+                index[utt] = (offset + start, length)
+            with open(ctm_file, 'rb') as inf:
+                shutil.copyfileobj(inf, outf)
+            offset = outf.tell()
+            if remove:
+                os.remove(ctm_file)
+                os.remove(index_path(ctm_file))
+    write_index(index, index_path(out_file))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print CTM lines for selected utterances from an indexed archive")
+    parser.add_argument('ctm_file', type=str,
+        help="Path to CTM archive, with index alongside in <ctm_file>.idx")
+    parser.add_argument('utts', type=str, nargs='*',
+        help="Utterance IDs to print (all if none given)")
+    parser.add_argument('--file-enc', type=str, default='utf-8',
+        help="File encoding for CTM text")
+    args = parser.parse_args()
+
+    with CtmArchive(args.ctm_file, args.file_enc) as archive:
+        for utt in args.utts or archive.keys():
+            sys.stdout.writelines(archive[utt])
@@ -3,10 +3,13 @@
 import argparse
 import os
 import re
+from contextlib import closing
+
+from ctm_archive import load_utt_list, read_ctm_lines
 
 
 def load_ctm(ctm_file, strip_pos=False, sil_to_sp=False, sil_symbols=('SIL', 'SP'),
-             enc='utf-8'):
+             enc='utf-8', subset=None):
     """Read Kaldi CTM file and split to per-utterance alignments
 
     Args:
@@ -17,6 +20,8 @@ def load_ctm(ctm_file, strip_pos=False, sil_to_sp=False, sil_symbols=('SIL', 'SP
       sil_symbols: Pair of symbols to use for leading/trailing silence and
         short pauses respectively. Output will match exactly, input should use
         the same character sequences but can be different case
+      subset: Optional collection of utterance IDs to load, read by seeking
+        directly to their lines using a CTM index
 
     Returns:
       utts: Dict mapping utterance IDs to string symbol sequences
@@ -24,7 +29,7 @@ def load_ctm(ctm_file, strip_pos=False, sil_to_sp=False, sil_symbols=('SIL', 'SP
     word_pos = re.compile(r"_(B|E|I|S)$")
     sil, sp = sil_symbols
     sil_nocase = sil.lower()
-    with open(ctm_file, encoding=enc) as inf:
+    with closing(read_ctm_lines(ctm_file, subset, enc)) as inf:
         prev_utt = ""
         utts = {}
         tokens = []
@@ -41,7 +46,8 @@ def load_ctm(ctm_file, strip_pos=False, sil_to_sp=False, sil_symbols=('SIL', 'SP
                 token = sp
             tokens.append(token)
             prev_utt = utt
-        utts[prev_utt] = tokens_to_text(tokens, sil_symbols)
+        if tokens:
+            utts[prev_utt] = tokens_to_text(tokens, sil_symbols)
     return utts
 
 
@@ -98,8 +104,12 @@ if __name__ == '__main__':
         help="Convert utterance IDs to .wav filenames under this directory")
     parser.add_argument('--file-enc', type=str, default='utf-8',
         help="File encoding for input/output text")
+    parser.add_argument('--utts', type=str, default=None,
+        help="Only process utterance IDs listed in the first field of this file, "
+        "e.g. retried_alignment.txt (reads them directly using a CTM index)")
     args = parser.parse_args()
 
+    subset = load_utt_list(args.utts) if args.utts is not None else None
     utts = load_ctm(args.ctm_file, args.strip_pos, args.sil_to_sp, args.sil_symbols,
-                    args.file_enc)
+                    args.file_enc, subset)
     write_meta(utts, args.text_out, args.sep, args.audio_root, args.file_enc)
@@ -3,40 +3,65 @@
 import argparse
 import os
 import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import closing
+from itertools import islice
+from multiprocessing import Pool
 
-import tgt
-from tgt.core import TextGrid, IntervalTier, Interval
+from ctm_archive import load_utt_list, read_ctm_lines
 
 
-def load_ctm(ctm_file, enc='utf-8'):
-    """Read Kaldi CTM file and split to per-utterance alignments
+# Intervals closer than this are treated as meeting, as in TextGridTools
+TIME_PRECISION = 0.0001
+
+
+def iter_ctm(ctm_file, enc='utf-8', subset=None):
+    """Read Kaldi CTM file one utterance at a time
 
     Args:
       ctm_file: Path to multi-utterance CTM file
+      subset: Optional collection of utterance IDs to read, by seeking
+        directly to their lines using a CTM index
 
-    Returns:
-      utts: Dict mapping utterance IDs to alignments represented as lists of
-        (token, start_time, duration) tuples
+    Yields:
+      utt: Utterance ID
+      tokens: Alignment represented as list of (token, start_time, duration)
+        tuples
     """
-    with open(ctm_file, encoding=enc) as inf:
+    with closing(read_ctm_lines(ctm_file, subset, enc)) as inf:
         prev_utt = ""
-        utts = {}
         tokens = []
         for i, line in enumerate(inf):
             utt, conf, start, dur, token = line.strip().split()
             if i == 0:
                 prev_utt = utt
             if prev_utt != utt:
-                utts[prev_utt] = tokens
+                yield prev_utt, tokens
                 tokens = []
             tokens.append((token, float(start), float(dur)))
             prev_utt = utt
-        utts[prev_utt] = tokens
-    return utts
+        if tokens:
+            yield prev_utt, tokens
 
 
-def load_ctm_with_punc(ctm_file, enc='utf-8'):
-    """Read Kaldi CTM file with punctuation and split to per-utterance alignments
+def load_ctm(ctm_file, enc='utf-8', subset=None):
+    """Read Kaldi CTM file and split to per-utterance alignments
+
+    Args:
+      ctm_file: Path to multi-utterance CTM file
+      subset: Optional collection of utterance IDs to load, read by seeking
+        directly to their lines using a CTM index
+
+    Returns:
+      utts: Dict mapping utterance IDs to alignments represented as lists of
+        (token, start_time, duration) tuples
+    """
+    return dict(iter_ctm(ctm_file, enc, subset))
+
+
+def iter_ctm_with_punc(ctm_file, enc='utf-8', subset=None):
+    """Read Kaldi CTM file with punctuation one utterance at a time
 
     Meant for phone CTM with punctuation symbols using PUNC phone (therefore
     transcribed as standalone words like PUNC_S). Punctuation intervals are
@@ -45,17 +70,19 @@ def load_ctm_with_punc(ctm_file, enc='utf-8'):
 
     Args:
       ctm_file: Path to multi-utterance CTM file
+      subset: Optional collection of utterance IDs to read, by seeking
+        directly to their lines using a CTM index
 
-    Returns:
-      utts: Dict mapping utterance IDs to alignments represented as lists of
-        (token, start_time, duration) tuples
+    Yields:
+      utt: Utterance ID
+      tokens: Alignment represented as list of (token, start_time, duration)
+        tuples
     """
-    with open(ctm_file, encoding=enc) as inf:
+    with closing(read_ctm_lines(ctm_file, subset, enc)) as inf:
         prev_utt = ""
         prev_token = ""
         prev_start = 0
         tmp_dur = 0
-        utts = {}
         tokens = []
         for i, line in enumerate(inf):
             utt, conf, start, dur, token = line.strip().split()
@@ -67,7 +94,7 @@ def load_ctm_with_punc(ctm_file, enc='utf-8'):
             if prev_utt != utt:
                 if prev_token in ["SIL", "PUNC_S"]:
                     tokens.append((prev_token, prev_start, tmp_dur))
-                utts[prev_utt] = tokens
+                yield prev_utt, tokens
                 tokens = []
                 prev_token = ""
                 tmp_dur = 0
@@ -90,8 +117,43 @@ def load_ctm_with_punc(ctm_file, enc='utf-8'):
             tokens.append((token, float(start), float(dur)))
             prev_utt = utt
             prev_token = token
-        utts[prev_utt] = tokens
-    return utts
+        if prev_token in ["SIL", "PUNC_S"]:
+            tokens.append((prev_token, prev_start, tmp_dur))
+        if tokens:
+            yield prev_utt, tokens
+
+
+def load_ctm_with_punc(ctm_file, enc='utf-8', subset=None):
+    """Read Kaldi CTM file with punctuation and split to per-utterance alignments
+
+    See iter_ctm_with_punc for details.
+
+    Args:
+      ctm_file: Path to multi-utterance CTM file
+      subset: Optional collection of utterance IDs to load, read by seeking
+        directly to their lines using a CTM index
+
+    Returns:
+      utts: Dict mapping utterance IDs to alignments represented as lists of
+        (token, start_time, duration) tuples
+    """
+    return dict(iter_ctm_with_punc(ctm_file, enc, subset))
+
+
+def iter_utt2dur(utt2dur_file):
+    """Read utterance durations from Kaldi utt2dur file one line at a time
+
+    Args:
+      utt2dur_file: Path to utt2dur file
+
+    Yields:
+      utt: Utterance ID
+      dur: Duration in seconds (float)
+    """
+    with open(utt2dur_file) as inf:
+        for line in inf:
+            utt, dur = line.strip().split()
+            yield utt, float(dur)
 
 
 def load_utt2dur(utt2dur_file):
@@ -103,12 +165,58 @@ def load_utt2dur(utt2dur_file):
     Returns:
       utt2dur: Dict mapping utterance IDs to durations in seconds (float)
     """
-    utt2dur = {}
-    with open(utt2dur_file) as inf:
-        for line in inf:
-            utt, dur = line.strip().split()
-            utt2dur[utt] = float(dur)
-    return utt2dur
+    return dict(iter_utt2dur(utt2dur_file))
+
+
+def iter_alignments(word_ctm, phone_ctm, utt2dur_file, enc='utf-8', punc=False, subset=None):
+    """Read word and phone alignments and durations together, per utterance
+
+    All three files are read in a single merge-join pass, so only one
+    utterance is held in memory at a time. Inputs must be sorted by
+    utterance ID in the same order, as Kaldi does (LC_ALL=C).
+
+    Args:
+      word_ctm: Path to word-level alignments in Kaldi CTM format
+      phone_ctm: Path to phone-level alignments in Kaldi CTM format
+      utt2dur_file: Path to Kaldi utt2dur file
+      enc: File encoding for CTM text
+      punc: Merge punctuation and silence intervals in phone alignments, as
+        in iter_ctm_with_punc
+      subset: Optional collection of utterance IDs to read, by seeking
+        directly to their lines using CTM indexes
+
+    Yields:
+      utt: Utterance ID
+      word_ali: Word-level alignment as list of (token, start_time, duration)
+        tuples
+      phone_ali: Phone-level alignment
+      utt_end: Utterance duration in seconds
+    """
+    words = iter_ctm(word_ctm, enc, subset)
+    if punc:
+        phones = iter_ctm_with_punc(phone_ctm, enc, subset)
+    else:
+        phones = iter_ctm(phone_ctm, enc, subset)
+    durs = iter_utt2dur(utt2dur_file)
+    word_utt, word_ali = next(words, (None, None))
+    dur_utt, utt_end = next(durs, (None, None))
+    for utt, phone_ali in phones:
+        # skip ahead past any utterances missing phone alignments
+        while word_utt is not None and word_utt < utt:
+            word_utt, word_ali = next(words, (None, None))
+        while dur_utt is not None and dur_utt < utt:
+            dur_utt, utt_end = next(durs, (None, None))
+        for missing, other_utt in [('word alignment', word_utt), ('duration', dur_utt)]:
+            if other_utt != utt:
+                raise ValueError("No {} found for utterance {} (are inputs sorted "
+                                 "consistently by utterance ID?)".format(missing, utt))
+        yield utt, word_ali, phone_ali, utt_end
+
+
+def count_lines(fname):
+    """Count lines in a file without decoding it"""
+    with open(fname, 'rb') as inf:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: inf.read(1 << 20), b''))
 
 
 def make_tier(tier_name, alignment, utt_start, utt_end, sil, strip_pos, punc_tier=None):
@@ -121,16 +229,22 @@ def make_tier(tier_name, alignment, utt_start, utt_end, sil, strip_pos, punc_tie
       utt_end: Time index of utterance end, in seconds
       sil: Symbol used for optional silence tokens
       strip_pos: Flag to strip word-position labels from aligned symbols
-      punc_tier: tgt.core.IntervalTier to extract original punctuation symbols
-        for PUNC phone intervals
+      punc_tier: Word tier as returned by this function, to extract original
+        punctuation symbols for PUNC phone intervals
 
     Returns:
-      tier: tgt.core.IntervalTier object representing aligned tokens
+      tier: Tuple like (tier_name, start_time, end_time, intervals), where
+        intervals is a list of (start_time, end_time, text) tuples
     """
     # pattern to strip Kaldi markers for phone position within words
     word_pos = re.compile(r"_(B|E|I|S)$")
 
-    tier = IntervalTier(utt_start, utt_end, tier_name)
+    if punc_tier is not None:
+        # boundaries of word intervals, for binary search of PUNC intervals
+        punc_ints = punc_tier[3]
+        punc_starts = [interval[0] for interval in punc_ints]
+        punc_ends = [interval[1] for interval in punc_ints]
+
     n_tokens = len(alignment)
     intervals = []
     for i, token in enumerate(alignment):
@@ -152,55 +266,243 @@ def make_tier(tier_name, alignment, utt_start, utt_end, sil, strip_pos, punc_tie
             start = round(start, 3)
             end = round(start + dur, 3)
         if punc_tier is not None and text == 'PUNC_S':
-            punc_ints = punc_tier.get_annotations_between_timepoints(start, end)
-            for punc_int in punc_ints:
-                text = punc_int.text
+            for punc_int in get_intervals_between(punc_ints, punc_starts, punc_ends, start, end):
+                text = punc_int[2]
                 if text not in ["sil", "sp"]:
                     break  # keep PUNC text only, merge with silence intervals
         if tier_name == 'phones' and strip_pos:
             text = re.sub(word_pos, '', text)
-        intervals.append(Interval(start, end, text))
-    tier.add_intervals(intervals)
-    return tier
+        intervals.append((start, end, text.strip()))
+    tier_start = min(utt_start, intervals[0][0]) if intervals else utt_start
+    tier_end = max(utt_end, intervals[-1][1]) if intervals else utt_end
+    return tier_name, tier_start, tier_end, intervals
+
+
+def get_intervals_between(intervals, starts, ends, start, end):
+    """Find intervals lying entirely between two time points
+
+    Uses binary search over interval boundaries, so repeated lookups over
+    one tier stay cheap even for very long utterances.
+
+    Args:
+      intervals: List of (start_time, end_time, text) tuples, sorted by time
+        and non-overlapping
+      starts: List of interval start times
+      ends: List of interval end times
+      start: Start time of search window, in seconds
+      end: End time of search window
+
+    Returns:
+      List of (start_time, end_time, text) tuples
+    """
+    lo = bisect_right(starts, start - TIME_PRECISION)
+    hi = bisect_left(ends, end + TIME_PRECISION)
+    return intervals[lo:hi]
 
 
-def write_textgrids(utts_word, utts_phone, utt2dur, tg_dir, sil_phone='SIL', strip_pos=False, punc=False):
+def fill_gaps(intervals, start_time, end_time):
+    """Fill any gaps between intervals with empty ones, as Praat expects
+
+    Args:
+      intervals: List of (start_time, end_time, text) tuples, sorted by time
+      start_time: Start time of the whole tier, in seconds
+      end_time: End time of the whole tier
+
+    Returns:
+      filled: List of (start_time, end_time, text) tuples covering the
+        whole tier with no gaps
+    """
+    filled = []
+    prev_end = start_time
+    for interval in intervals:
+        if interval[0] - prev_end >= TIME_PRECISION:
+            filled.append((prev_end, interval[0], ''))
+        filled.append(interval)
+        prev_end = interval[1]
+    if end_time - prev_end >= TIME_PRECISION:
+        filled.append((prev_end, end_time, ''))
+    return filled
+
+
+def format_textgrid(tiers, fmt='long'):
+    """Serialize interval tiers as Praat TextGrid text
+
+    Args:
+      tiers: List of tiers as returned by make_tier
+      fmt: TextGrid text format (long|short)
+
+    Returns:
+      textgrid: TextGrid file contents
+    """
+    xmin = float(min(tier[1] for tier in tiers))
+    xmax = float(max(tier[2] for tier in tiers))
+    if fmt == 'long':
+        lines = ['File type = "ooTextFile"',
+                 'Object class = "TextGrid"',
+                 '',
+                 'xmin = {}'.format(xmin),
+                 'xmax = {}'.format(xmax),
+                 'tiers? <exists>',
+                 'size = {}'.format(len(tiers)),
+                 'item []:']
+    else:
+        lines = ['File type = "ooTextFile"',
+                 'Object class = "TextGrid"',
+                 '',
+                 str(xmin),
+                 str(xmax),
+                 '<exists>',
+                 str(len(tiers))]
+    for i, (name, _, _, intervals) in enumerate(tiers, 1):
+        intervals = fill_gaps(intervals, xmin, xmax)
+        tier_xmin = float(min(intervals[0][0], xmin))
+        tier_xmax = float(max(intervals[-1][1], xmax))
+        name = name.replace('"', '""')
+        if fmt == 'long':
+            lines += ['\titem [{}]:'.format(i),
+                      '\t\tclass = "IntervalTier"',
+                      '\t\tname = "{}"'.format(name),
+                      '\t\txmin = {}'.format(tier_xmin),
+                      '\t\txmax = {}'.format(tier_xmax),
+                      '\t\tintervals: size = {}'.format(len(intervals))]
+            for j, (start, end, text) in enumerate(intervals, 1):
+                lines += ['\t\tintervals [{}]:'.format(j),
+                          '\t\t\txmin = {}'.format(float(start)),
+                          '\t\t\txmax = {}'.format(float(end)),
+                          '\t\t\ttext = "{}"'.format(text.replace('"', '""'))]
+        else:
+            lines += ['"IntervalTier"',
+                      '"{}"'.format(name),
+                      str(tier_xmin),
+                      str(tier_xmax),
+                      str(len(intervals))]
+            for start, end, text in intervals:
+                lines += [str(float(start)),
+                          str(float(end)),
+                          '"{}"'.format(text.replace('"', '""'))]
+    return '\n'.join(lines)
+
+
+def validate_textgrid(tgf, tiers, enc='utf-8'):
+    """Check TextGrid file written by us can be read back by TextGridTools
+
+    Args:
+      tgf: Path to TextGrid file
+      tiers: List of tiers as returned by make_tier, which were written to tgf
+      enc: TextGrid file encoding
+
+    Raises:
+      ValueError: If tiers read from file do not match those written
+    """
+    import tgt  # only needed for validation
+    textgrid = tgt.io.read_textgrid(tgf, enc)
+    if textgrid.get_tier_names() != [tier[0] for tier in tiers]:
+        raise ValueError("Tier names do not match in {}".format(tgf))
+    for name, _, _, intervals in tiers:
+        tg_intervals = [i for i in textgrid.get_tier_by_name(name) if i.text]
+        intervals = [i for i in intervals if i[2]]
+        if len(tg_intervals) != len(intervals) or any(
+                (i.start_time, i.end_time, i.text) != (start, end, text)
+                for i, (start, end, text) in zip(tg_intervals, intervals)):
+            raise ValueError("Intervals in tier {} do not match in {}".format(name, tgf))
+
+
+def write_textgrid(utt, word_ali, phone_ali, utt_end, tg_dir, sil_phone='SIL',
+                   strip_pos=False, punc=False, fmt='long', validate=False):
+    """Write TextGrid file with word- and phone-level alignments for one utterance
+
+    Args:
+      utt: Utterance ID, also used for TextGrid file name
+      word_ali: Word-level alignment as list of (token, start_time, duration)
+        tuples
+      phone_ali: Phone-level alignment
+      utt_end: Utterance duration in seconds
+      tg_dir: Directory to write TextGrid file
+      sil_phone: Phone symbol used for optional silence
+      strip_pos: Flag to strip word-position labels from aligned symbols
+      punc: Restore punctuation symbols in phone tier from word tier
+      fmt: TextGrid text format (long|short)
+      validate: Read back written file using TextGridTools to check it
+    """
+    utt_start = 0
+    # nb. we do nothing about OOV items here -- they will be marked by
+    # whatever symbols Kaldi knows about, e.g. <unk> in words tier and
+    # SPN in phones tier
+    tgf = os.path.join(tg_dir, f"{utt}.TextGrid")
+    word_tier = make_tier("words", word_ali, utt_start, utt_end, '<eps>', strip_pos)
+    if punc:
+        phone_tier = make_tier("phones", phone_ali, utt_start, utt_end, sil_phone, strip_pos, word_tier)
+    else:
+        phone_tier = make_tier("phones", phone_ali, utt_start, utt_end, sil_phone, strip_pos)
+    tiers = [word_tier, phone_tier]
+    with open(tgf, 'w', encoding='utf-8') as outf:
+        outf.write(format_textgrid(tiers, fmt))
+    if validate:
+        validate_textgrid(tgf, tiers)
+
+
+def _write_textgrid_shard(args):
+    shard, tg_dir, sil_phone, strip_pos, punc, fmt, validate = args
+    for utt, word_ali, phone_ali, utt_end in shard:
+        write_textgrid(utt, word_ali, phone_ali, utt_end, tg_dir, sil_phone, strip_pos, punc,
+                       fmt, validate)
+    return len(shard)
+
+
+def print_progress(n_done, num_utts):
+    """Print progress bar for TextGrid creation, overwriting previous line"""
+    log_line_end = '\n' if n_done == num_utts else '\r'
+    n_bar = int(n_done / num_utts * 40)
+    print("Creating TextGrids [{}{}] {}/{}".format(
+          n_bar * '#', (40 - n_bar) * '-', n_done, num_utts),
+          end=log_line_end, flush=True)
+
+
+def write_textgrids(utt_alis, num_utts, tg_dir, sil_phone='SIL', strip_pos=False,
+                    punc=False, nj=1, shard_size=100, fmt='long', validate=False):
     """Write TextGrid files with word- and phone-level alignments per utterance 
 
     Args:
-      utts_word: Dict mapping utterance IDs to word-level alignments stored as
-        lists of (token, start_time, duration) tuples
-      utts_phone: Dict mapping utterance IDs to phone-level alignments
-      utt2dur: Dict mapping utterance IDs to durations
+      utt_alis: Iterable over tuples like (utt, word_ali, phone_ali, utt_end)
+        with word- and phone-level alignments stored as lists of
+        (token, start_time, duration) tuples, e.g. from iter_alignments
+      num_utts: Expected number of utterances, for progress reporting
       tg_dir: Directory to write TextGrid files per utterance
       sil_phone: Phone symbol used for optional silence
       strip_pos: Flag to strip word-position labels from aligned symbols
+      punc: Restore punctuation symbols in phone tier from word tier
+      nj: Number of parallel processes writing TextGrids
+      shard_size: Number of utterances sent to a worker process at a time
+      fmt: TextGrid text format (long|short)
+      validate: Read back written files using TextGridTools to check them
     """
-    num_utts = len(utts_phone)
-    assert len(utts_word) == num_utts
-    for i, utt in enumerate(utts_phone, 1):
-        utt_start = 0
-        utt_end = utt2dur[utt]
-        # nb. we do nothing about OOV items here -- they will be marked by
-        # whatever symbols Kaldi knows about, e.g. <unk> in words tier and
-        # SPN in phones tier
-        tgf = os.path.join(tg_dir, f"{utt}.TextGrid")
-        textgrid = TextGrid(tgf)
-        word_tier = make_tier("words", utts_word[utt], utt_start, utt_end, '<eps>', strip_pos)
-        textgrid.add_tier(word_tier)
-        if punc:
-            phone_tier = make_tier("phones", utts_phone[utt], utt_start, utt_end, sil_phone, strip_pos, word_tier)
-        else:
-            phone_tier = make_tier("phones", utts_phone[utt], utt_start, utt_end, sil_phone, strip_pos)
-        textgrid.add_tier(phone_tier)
-        tgt.io.write_to_file(textgrid, tgf, format="long")
-
-        # progress bar
-        log_line_end = '\n' if i == num_utts else '\r'
-        n_done = int(i / num_utts * 40)
-        print("Creating TextGrids [{}{}] {}/{}".format(
-              n_done * '#', (40 - n_done) * '-', i, num_utts),
-              end=log_line_end)
+    n_done = 0
+    if nj > 1:
+        # each worker only receives alignments and durations for its own
+        # shard, and we only read ahead a few shards per worker so memory
+        # stays bounded when streaming alignments
+        utt_alis = iter(utt_alis)
+        shards = iter(lambda: list(islice(utt_alis, shard_size)), [])
+        pending = deque()
+        with Pool(nj) as pool:
+            for shard in shards:
+                shard_args = (shard, tg_dir, sil_phone, strip_pos, punc, fmt, validate)
+                pending.append(pool.apply_async(_write_textgrid_shard, (shard_args,)))
+                if len(pending) >= 2 * nj:
+                    n_done += pending.popleft().get()
+                    print_progress(n_done, max(n_done, num_utts))
+            while pending:
+                n_done += pending.popleft().get()
+                print_progress(n_done, max(n_done, num_utts))
+    else:
+        for utt, word_ali, phone_ali, utt_end in utt_alis:
+            write_textgrid(utt, word_ali, phone_ali, utt_end, tg_dir, sil_phone, strip_pos, punc,
+                           fmt, validate)
+            n_done += 1
+            print_progress(n_done, max(n_done, num_utts))
+    if n_done < num_utts:
+        # some utterances were not aligned, complete progress bar
+        print_progress(n_done, n_done)
 
 
 if __name__ == '__main__':
@@ -223,15 +525,27 @@ if __name__ == '__main__':
         help="Directory containing data to be aligned")
     parser.add_argument('--file-enc', type=str, default='utf-8',
         help="File encoding for input/output text")
+    parser.add_argument('--format', type=str, choices=['long', 'short'], default='long',
+        help="TextGrid text format")
+    parser.add_argument('--validate', action='store_true',
+        help="Check each TextGrid can be read back by TextGridTools (requires tgt)")
+    parser.add_argument('--nj', type=int, default=1,
+        help="Number of parallel processes writing TextGrids")
+    parser.add_argument('--utts', type=str, default=None,
+        help="Only process utterance IDs listed in the first field of this file, "
+        "e.g. retried_alignment.txt (reads them directly using CTM indexes)")
     args = parser.parse_args()
 
-
-    utts_word = load_ctm(args.word_ctm, args.file_enc)
-    if args.punc:
-        utts_phone = load_ctm_with_punc(args.phone_ctm)
+    utt2dur = os.path.join(args.datadir, 'utt2dur')
+    if args.utts is not None:
+        subset = load_utt_list(args.utts)
+        num_utts = len(subset)
     else:
-        utts_phone = load_ctm(args.phone_ctm)
-    utt2dur = load_utt2dur(os.path.join(args.datadir, 'utt2dur'))
+        subset = None
+        num_utts = count_lines(utt2dur)
+    utt_alis = iter_alignments(args.word_ctm, args.phone_ctm, utt2dur, args.file_enc,
+                               args.punc, subset)
 
     os.makedirs(args.tg_dir, exist_ok=True)
-    write_textgrids(utts_word, utts_phone, utt2dur, args.tg_dir, args.sil, args.strip_pos, args.punc)
+    write_textgrids(utt_alis, num_utts, args.tg_dir, args.sil, args.strip_pos, args.punc,
+                    args.nj, fmt=args.format, validate=args.validate)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+Write and check Kaldi data directories in a single pass.
+
+Kaldi expects every file in a data directory to be sorted by its first field
+in C locale byte order, which for UTF-8 text is the same as Python string
+comparison. Speaker IDs should also be prefixes of utterance IDs, so that
+utt2spk sorted by utterance is sorted by speaker as well. If utterances are
+written in sorted order and these conditions are checked as we go, then all
+data files including spk2utt can be streamed out together, and there is no
+need for separate sorting and validation passes afterwards.
+"""
+
+import argparse
+import os
+import sys
+from itertools import zip_longest
+
+
+class DataDirWriter():
+    """Write consistent Kaldi data files for utterances in sorted order
+
+    Always writes text, utt2spk and spk2utt. Audio goes to wav.scp per
+    utterance, or to segments with recordings listed in wav.scp through
+    write_recording. Raises ValueError if utterances are out of order,
+    repeated or have inconsistent speaker IDs.
+
+    Args:
+      datadir: Output data directory
+      utt2dur: Also write utterance durations to utt2dur
+      utt2num_frames: Also write numbers of feature frames to utt2num_frames
+      segments: Write utterance segments of recordings to segments file
+      enc: File encoding for transcripts
+    """
+    def __init__(self, datadir, utt2dur=False, utt2num_frames=False, segments=False,
+                 enc='utf-8'):
+        self.datadir = datadir
+        os.makedirs(datadir, exist_ok=True)
+        self.prev_utt = None
+        self.prev_rec = None
+        self.speaker = None
+        self.speaker_utts = []
+        self.num_utts = 0
+        self._files = {}
+        for fname in ['text', 'utt2spk', 'spk2utt', 'wav.scp']:
+            self._open(fname, enc)
+        if utt2dur:
+            self._open('utt2dur', enc)
+        if utt2num_frames:
+            self._open('utt2num_frames', enc)
+        if segments:
+            self._open('segments', enc)
+
+    def _open(self, fname, enc):
+        self._files[fname] = open(os.path.join(self.datadir, fname), 'w', encoding=enc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, utt, speaker, transcript, wav=None, dur=None, num_frames=None,
+              segment=None):
+        """Write data file entries for the next utterance
+
+        Args:
+          utt: Utterance ID, must sort after all previous utterance IDs
+          speaker: Speaker ID, must be a prefix of utterance ID
+          transcript: Utterance transcript
+          wav: Audio path or Kaldi extended filename, if not using segments
+          dur: Utterance duration in seconds, if writing utt2dur
+          num_frames: Number of feature frames, if writing utt2num_frames
+          segment: Tuple like (recording_id, start_time, end_time), if
+            using segments
+        """
+        if self.prev_utt is not None and utt <= self.prev_utt:
+            if utt == self.prev_utt:
+                raise ValueError("Duplicate utterance ID {}".format(utt))
+            raise ValueError("Utterance {} is out of order, after {}".format(utt, self.prev_utt))
+        if not utt.startswith(speaker):
+            raise ValueError("Speaker ID {} is not a prefix of utterance ID {}".format(
+                speaker, utt))
+        if speaker != self.speaker:
+            if self.speaker is not None and speaker < self.speaker:
+                raise ValueError(
+                    "Speaker {} of utterance {} sorts before previous speaker {}, so utt2spk "
+                    "would not be sorted by speaker".format(speaker, utt, self.speaker))
+            self._write_speaker()
+            self.speaker = speaker
+        self.speaker_utts.append(utt)
+        self.prev_utt = utt
+        self.num_utts += 1
+
+        self._files['text'].write("{} {}\n".format(utt, transcript))
+        self._files['utt2spk'].write("{} {}\n".format(utt, speaker))
+        if segment is not None:
+            self._files['segments'].write("{} {} {} {}\n".format(utt, *segment))
+        else:
+            self._files['wav.scp'].write("{} {}\n".format(utt, wav))
+        if dur is not None:
+            # same precision as Kaldi's wav-to-duration
+            self._files['utt2dur'].write("{} {:g}\n".format(utt, dur))
+        if num_frames is not None:
+            self._files['utt2num_frames'].write("{} {}\n".format(utt, num_frames))
+
+    def write_recording(self, rec, wav):
+        """Write wav.scp entry for the next recording, when using segments
+
+        Args:
+          rec: Recording ID, must sort after all previous recording IDs
+          wav: Audio path or Kaldi extended filename
+        """
+        if self.prev_rec is not None and rec <= self.prev_rec:
+            raise ValueError("Recording {} is duplicate or out of order, after {}".format(
+                rec, self.prev_rec))
+        self.prev_rec = rec
+        self._files['wav.scp'].write("{} {}\n".format(rec, wav))
+
+    def _write_speaker(self):
+        if self.speaker_utts:
+            self._files['spk2utt'].write("{} {}\n".format(self.speaker, ' '.join(self.speaker_utts)))
+            self.speaker_utts = []
+
+    def close(self):
+        self._write_speaker()
+        for outf in self._files.values():
+            outf.close()
+
+
+def iter_keys(fname, enc='utf-8'):
+    """Iterate over first field of each line in a Kaldi data file
+
+    Raises ValueError if keys are not strictly increasing.
+    """
+    prev = None
+    with open(fname, encoding=enc) as inf:
+        for lineno, line in enumerate(inf, 1):
+            key = line.split(maxsplit=1)[0] if line.strip() else ''
+            if not key:
+                raise ValueError("{}: empty line {}".format(fname, lineno))
+            if prev is not None and key <= prev:
+                raise ValueError("{}: line {} is duplicate or out of order: {}".format(
+                    fname, lineno, key))
+            prev = key
+            yield key
+
+
+def check_data_dir(datadir, enc='utf-8'):
+    """Check Kaldi data directory is sorted and consistent in one pass per file
+
+    Covers the same sorting and consistency requirements as Kaldi's
+    validate_data_dir.sh for text, utt2spk, spk2utt, wav.scp, segments,
+    feats.scp, cmvn.scp, utt2dur and utt2num_frames (where present).
+
+    Args:
+      datadir: Kaldi data directory
+      enc: File encoding for transcripts
+
+    Returns:
+      num_utts: Number of utterances
+
+    Raises:
+      ValueError: Describing the first problem found
+    """
+    def path(fname):
+        return os.path.join(datadir, fname)
+
+    for fname in ['text', 'utt2spk', 'spk2utt', 'wav.scp']:
+        if not os.path.exists(path(fname)):
+            raise ValueError("{}: missing required file".format(path(fname)))
+    has_segments = os.path.exists(path('segments'))
+
+    # all per-utterance files must list exactly the same utterances
+    utt_files = ['utt2spk', 'text']
+    utt_files += ['segments'] if has_segments else ['wav.scp']
+    utt_files += [f for f in ['feats.scp', 'utt2dur', 'utt2num_frames']
+                  if os.path.exists(path(f))]
+    num_utts = 0
+    missing = object()
+    with open(path('utt2spk'), encoding=enc) as utt2spk, \
+            open(path('spk2utt'), encoding=enc) as spk2utt:
+        key_iters = [iter_keys(path(f), enc) for f in utt_files]
+        speaker = None
+        speaker_utts = []
+        speakers = []
+
+        def check_speaker():
+            line = spk2utt.readline().split()
+            if line != [speaker] + speaker_utts:
+                raise ValueError("{}: entry for speaker {} does not match utt2spk".format(
+                    path('spk2utt'), speaker))
+            speakers.append(speaker)
+
+        for keys in zip_longest(*key_iters, fillvalue=missing):
+            utt = keys[0]
+            for fname, key in zip(utt_files, keys):
+                if key != utt:
+                    raise ValueError("{}: utterance mismatch with utt2spk, got {} for {}".format(
+                        path(fname), 'end of file' if key is missing else key,
+                        'end of file' if utt is missing else utt))
+            utt_spk = utt2spk.readline().split()
+            if len(utt_spk) != 2:
+                raise ValueError("{}: bad line for utterance {}".format(path('utt2spk'), utt))
+            if utt_spk[1] != speaker:
+                if speaker is not None:
+                    if utt_spk[1] < speaker:
+                        raise ValueError(
+                            "{}: not sorted by speaker at utterance {}, make speaker IDs "
+                            "prefixes of utterance IDs".format(path('utt2spk'), utt))
+                    check_speaker()
+                speaker = utt_spk[1]
+                speaker_utts = []
+            speaker_utts.append(utt)
+            num_utts += 1
+        if speaker is not None:
+            check_speaker()
+        if spk2utt.readline():
+            raise ValueError("{}: speakers not found in utt2spk".format(path('spk2utt')))
+
+    if os.path.exists(path('cmvn.scp')):
+        cmvn_speakers = list(iter_keys(path('cmvn.scp'), enc))
+        if cmvn_speakers != speakers:
+            raise ValueError("{}: speakers do not match spk2utt".format(path('cmvn.scp')))
+
+    if has_segments:
+        recordings = set(iter_keys(path('wav.scp'), enc))
+        with open(path('segments'), encoding=enc) as inf:
+            for line in inf:
+                fields = line.split()
+                if len(fields) != 4 or fields[1] not in recordings:
+                    raise ValueError("{}: bad segment or unknown recording: {}".format(
+                        path('segments'), line.strip()))
+                if not 0 <= float(fields[2]) < float(fields[3]):
+                    raise ValueError("{}: bad segment times: {}".format(
+                        path('segments'), line.strip()))
+
+    with open(path('text'), encoding=enc) as inf:
+        for line in inf:
+            if not all(c.isprintable() or c.isspace() for c in line):
+                raise ValueError("{}: non-printable characters in line: {}".format(
+                    path('text'), line.strip()))
+
+    return num_utts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Check Kaldi data directory is sorted and consistent")
+    parser.add_argument('datadir', type=str,
+        help="Kaldi data directory")
+    parser.add_argument('--file-enc', type=str, default='utf-8',
+        help="File encoding for transcripts")
+    args = parser.parse_args()
+
+    try:
+        num_utts = check_data_dir(args.datadir, args.file_enc)
+    except (ValueError, UnicodeDecodeError) as e:
+        print("{}: {}".format(sys.argv[0], e), file=sys.stderr)
+        sys.exit(1)
+    print("{}: Successfully validated data-directory {} ({} utterances)".format(
+        sys.argv[0], args.datadir, num_utts))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""
+Helpers for sorting more records than fit in memory.
+
+Records are sorted in chunks which are spilled to temporary run files, then
+all runs are merged lazily. Any picklable, comparable records will do, e.g.
+tuples starting with a sort key.
+"""
+
+import heapq
+import pickle
+
+
+# records per pickle block in sorted run files
+RUN_BLOCK_SIZE = 1000
+
+
+def write_run(records, run_file):
+    """Write sorted records to a temporary run file in pickled blocks"""
+    with open(run_file, 'wb') as outf:
+        for i in range(0, len(records), RUN_BLOCK_SIZE):
+            pickle.dump(records[i:i + RUN_BLOCK_SIZE], outf, pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(run_file):
+    """Iterate over records in a run file written by write_run"""
+    with open(run_file, 'rb') as inf:
+        while True:
+            try:
+                block = pickle.load(inf)
+            except EOFError:
+                return
+            yield from block
+
+
+def merge_runs(run_files):
+    """Merge sorted run files
+
+    Args:
+      run_files: Paths to run files written by write_run
+
+    Yields:
+      record: Records from all runs, in sorted order
+    """
+    yield from heapq.merge(*[read_run(run_file) for run_file in run_files])
@@ -3,6 +3,7 @@
 # begin configuration section.
 cmd=run.pl
 frame_shift=10.0
+archive=false
 #end configuration section.
 
 echo "$0 $@"  # Print the command line for logging.
@@ -16,6 +17,8 @@ if [ $# -ne 3 ]; then
   echo "    --cmd (run.pl|queue.pl...)      # specify how to run the sub-processes."
   echo "    --frame-shift (default=10.0)    # specify this if your alignments have a frame-shift"
   echo "                                    # not equal to 10.0 milliseconds"
+  echo "    --archive (true|false)          # write a single indexed archive <output-dir>/ctm"
+  echo "                                    # instead of per-utterance ctm files"
   echo "e.g.:"
   echo "$0 data/lang exp/tri3a_ali phone_state_ctm"
   echo "Produces per-utterance ctm in: phone_state_ctm/utt_id"
@@ -46,5 +49,7 @@ $cmd JOB=1:$nj $ali_dir/log/get_state_alignment.JOB.log \
 show-transitions $lang/phones.txt $model $ali_dir/final.occs > $ali_dir/transitions
 
 # write phone-state ctm files per utterance
-python3 local/transitions_to_phone_ctm.py --nj $nj --frame-shift $frame_shift \
+[ $archive == true ] && archive="--archive" || archive=""
+python3 local/transitions_to_phone_ctm.py --nj $nj --num-procs $nj \
+  --frame-shift $frame_shift $archive \
   $ali_dir/transitions $ali_dir $ctm_dir
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
-import locale
+import hashlib
 import os
-from collections import defaultdict
+import shutil
+import subprocess
+import tempfile
+from collections import defaultdict, deque
+from itertools import islice
+from multiprocessing import Pool
+
+from audio_info import map_audio_files, num_frames, probe_audio_files
+from data_dir import DataDirWriter
+from external_sort import merge_runs, write_run
 
 
 RESAMPLE_TEMPLATES = {
@@ -17,6 +26,12 @@ RESAMPLE_TEMPLATES = {
 """,
 }
 
+# commands to resample audio once to a file, for caching
+RESAMPLE_COMMANDS = {
+    'sox': "sox -G {src} -c 1 -r {rate} -b 16 -e signed-integer -t wav {dst}",
+    'ffmpeg': "ffmpeg -v 24 -y -i {src} -ac 1 -ar {rate} -acodec pcm_s16le -f wav {dst}",
+}
+
 
 def audio2utt(audio_path, audio_root, spkr_sep='-', spkr_in_wav=False):
     """Convert audio file path to utterance ID
@@ -41,6 +56,67 @@ def audio2utt(audio_path, audio_root, spkr_sep='-', spkr_in_wav=False):
     return utt_id
 
 
+def parse_meta_line(line, audio_root, field_sep=' ', spkr_sep='-', spkr_in_wav=False):
+    """Parse one line of metadata file
+
+    Args:
+      line: Line from metadata file, with audio path and transcript
+      audio_root: Longest common subpath across audio files
+      field_sep: Character separating fields in metadata file
+      spkr_sep: Character joining speaker ID prefix to utterance ID
+      spkr_in_wav: True if speaker ID is already part of audio filename
+
+    Returns:
+      utt_id: Utterance ID inferred from audio filename
+      speaker: Speaker ID
+      transcript: Utterance transcript
+      audio_path: Full path to audio file
+    """
+    audio_path, *transcript = line.strip().split(field_sep)
+    utt_id = audio2utt(audio_path, audio_root, spkr_sep, spkr_in_wav)
+    speaker = utt_id.split(spkr_sep)[0]
+    return utt_id, speaker, ' '.join(transcript), audio_path
+
+
+def wav_entry(audio_path, resample=0, resample_method='sox'):
+    """Get wav.scp entry for audio file, resampling on the fly if required
+
+    Args:
+      audio_path: Full path to audio file
+      resample: Target sample rate if audio needs converting
+      resample_method: Tool to use for resampling audio (sox|ffmpeg|kaldi)
+
+    Returns:
+      wav: Audio path, or Kaldi extended filename if resampling
+    """
+    if not resample or resample_method == 'kaldi':
+        return audio_path
+    return RESAMPLE_TEMPLATES[resample_method].format(audio_path, resample)
+
+
+def read_meta(meta, audio_root, field_sep=' ', spkr_sep='-', spkr_in_wav=False):
+    """Read metadata file into memory
+
+    Args:
+      meta: Path to input metadata file, listing full audio paths and transcripts
+      audio_root: Longest common subpath across audio files
+      field_sep: Character separating fields in metadata file
+      spkr_sep: Character joining speaker ID prefix to utterance ID
+      spkr_in_wav: True if speaker ID is already part of audio filename
+
+    Returns:
+      utts: Dict mapping utterance IDs to (speaker, transcript, audio_path)
+        tuples, keeping the last line for any duplicate utterance IDs
+    """
+    utts = {}
+    with open(meta) as inf:
+        for line in inf:
+            utt_id, *utt_info = parse_meta_line(
+                line, audio_root, field_sep, spkr_sep, spkr_in_wav)
+            utts[utt_id] = tuple(utt_info)
+    return utts
+
+
 def process_meta(meta, audio_root, resample=0, resample_method='sox',
                  field_sep=' ', spkr_sep='-', spkr_in_wav=False):
     """Create Kaldi data files from metadata file
@@ -64,34 +140,311 @@ def process_meta(meta, audio_root, resample=0, resample_method='sox',
     wavscp = {}
     utt2spk = {}
     spk2utt = defaultdict(list)
-    with open(meta) as inf:
-        for line in inf:
-            audio_path, *transcript = line.strip().split(field_sep)
-            utt_id = audio2utt(audio_path, audio_root, spkr_sep, spkr_in_wav)
-            text[utt_id] = ' '.join(transcript)
-            speaker = utt_id.split(spkr_sep)[0]
-            utt2spk[utt_id] = speaker
-            spk2utt[speaker].append(utt_id)
-            if not resample or resample_method == 'kaldi':
-                wavscp[utt_id] = audio_path
-            else:
-                wavscp[utt_id] = RESAMPLE_TEMPLATES[resample_method].format(audio_path, resample)
+    for utt_id, (speaker, transcript, audio_path) in read_meta(
+            meta, audio_root, field_sep, spkr_sep, spkr_in_wav).items():
+        text[utt_id] = transcript
+        utt2spk[utt_id] = speaker
+        spk2utt[speaker].append(utt_id)
+        wavscp[utt_id] = wav_entry(audio_path, resample, resample_method)
     spk2utt = {spk: ' '.join(utts) for spk, utts in spk2utt.items()}
     return text, wavscp, utt2spk, spk2utt
 
 
-def write_dict(outdict, outpath):
-    """Write dictionary keys and values, sorted consistently with Kaldi
+def resample_cache_path(audio_path, cache_dir, resample, resample_method='sox'):
+    """Get path to cached resampled audio
+
+    Cached files are named by a hash of the absolute source path, its mtime
+    and size, and resampling settings, so changes to any of these give a new
+    cache entry.
+
+    Args:
+      audio_path: Full path to source audio file
+      cache_dir: Directory storing resampled audio
+      resample: Target sample rate
+      resample_method: Tool to use for resampling audio (sox|ffmpeg)
+
+    Returns:
+      cached_path: Path to resampled audio in cache
+    """
+    stat = os.stat(audio_path)
+    key = '\0'.join([os.path.abspath(audio_path), str(stat.st_mtime_ns), str(stat.st_size),
+                     str(resample), resample_method])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, digest[:2], digest + '.wav')
+
+
+def resample_to_cache(audio_path, cache_dir, resample, resample_method='sox'):
+    """Resample audio file into cache, unless it is already there
 
     Args:
-      outdict: Dict with data to write
-      outpath: Output file path
+      audio_path: Full path to source audio file
+      cache_dir: Directory storing resampled audio
+      resample: Target sample rate
+      resample_method: Tool to use for resampling audio (sox|ffmpeg)
+
+    Returns:
+      cached_path: Path to resampled audio in cache
     """
-    # sort as LC_ALL=C for compatibility with Kaldi sorting
-    locale.setlocale(locale.LC_ALL, 'C')
-    with open(outpath, 'w') as outf:
-        for k, v in sorted(outdict.items(), key=lambda x: locale.strxfrm(x[0])):
-            outf.write("{} {}\n".format(k, v))
+    cached_path = resample_cache_path(audio_path, cache_dir, resample, resample_method)
+    if os.path.exists(cached_path):
+        return cached_path
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    # write to temporary file then rename, so interrupted or concurrent runs
+    # never leave partial files in the cache
+    fd, tmp_path = tempfile.mkstemp(suffix='.wav', dir=os.path.dirname(cached_path))
+    os.close(fd)
+    cmd = [arg.format(src=audio_path, dst=tmp_path, rate=resample)
+           for arg in RESAMPLE_COMMANDS[resample_method].split()]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        os.remove(tmp_path)
+        err = e.stderr.decode(errors='replace').strip().splitlines()
+        raise ValueError("{} failed: {}".format(resample_method, err[-1] if err else e))
+    os.replace(tmp_path, cached_path)
+    return cached_path
+
+
+def utt_hash(audio_path, transcript, wav):
+    """Hash utterance audio and transcript, to detect changes between runs
+
+    Args:
+      audio_path: Full path to audio file
+      transcript: Utterance transcript
+      wav: wav.scp entry for utterance
+
+    Returns:
+      digest: Hex digest covering audio path, size and modification time,
+        transcript and wav.scp entry
+    """
+    try:
+        stat = os.stat(audio_path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+    except OSError:
+        size, mtime = -1, -1
+    key = '\0'.join([audio_path, str(size), str(mtime), transcript, wav])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def iter_manifest(manifest):
+    """Iterate over (utt_id, digest) pairs in manifest file, if it exists"""
+    if not os.path.exists(manifest):
+        return
+    with open(manifest, encoding='utf-8') as inf:
+        for line in inf:
+            utt_id, digest = line.split()
+            yield utt_id, digest
+
+
+def diff_manifests(old_manifest, new_manifest, delta_prefix):
+    """Compare manifests from previous and current data prep runs
+
+    Both manifests are sorted by utterance ID, so they are merged in a single
+    pass and only the changes are written out, to files named like
+    <delta_prefix>_{added,changed,removed}.txt listing utterance IDs.
+
+    Args:
+      old_manifest: Path to manifest from previous run (may not exist)
+      new_manifest: Path to manifest from this run
+      delta_prefix: Prefix for output utterance lists
+
+    Returns:
+      counts: Dict with numbers of added, changed and removed utterances
+    """
+    counts = {}
+    outf = {}
+    for delta in ['added', 'changed', 'removed']:
+        counts[delta] = 0
+        outf[delta] = open('{}_{}.txt'.format(delta_prefix, delta), 'w', encoding='utf-8')
+    end = (None, None)
+    old = iter_manifest(old_manifest)
+    new = iter_manifest(new_manifest)
+    old_utt, old_hash = next(old, end)
+    new_utt, new_hash = next(new, end)
+    while old_utt is not None or new_utt is not None:
+        if new_utt is None or (old_utt is not None and old_utt < new_utt):
+            delta = 'removed'
+            outf[delta].write(old_utt + '\n')
+            old_utt, old_hash = next(old, end)
+        elif old_utt is None or new_utt < old_utt:
+            delta = 'added'
+            outf[delta].write(new_utt + '\n')
+            new_utt, new_hash = next(new, end)
+        else:
+            delta = 'changed' if old_hash != new_hash else None
+            if delta:
+                outf[delta].write(new_utt + '\n')
+            old_utt, old_hash = next(old, end)
+            new_utt, new_hash = next(new, end)
+        if delta:
+            counts[delta] += 1
+    for f in outf.values():
+        f.close()
+    return counts
+
+
+def write_data_dir(utts, datadir, resample=0, resample_method='sox', probe_audio=False,
+                   num_threads=8, frame_length=0.025, frame_shift=0.01, bad_audio=None,
+                   resample_cache=None, manifest=None):
+    """Write Kaldi data files, sorted consistently with Kaldi
+
+    Args:
+      utts: Iterable over (utt_id, speaker, transcript, audio_path) tuples,
+        sorted by utterance ID
+      datadir: Output data directory
+      resample: Target sample rate if audio needs converting
+      resample_method: Tool to use for resampling audio (sox|ffmpeg|kaldi)
+      probe_audio: Read WAV/FLAC headers to write utt2dur and utt2num_frames,
+        excluding utterances with unreadable or too-short audio
+      num_threads: Number of threads reading audio headers or resampling
+      frame_length: Feature frame length in seconds, for utt2num_frames
+      frame_shift: Feature frame shift in seconds, for utt2num_frames
+      bad_audio: Path to list utterances excluded for bad audio
+      resample_cache: Directory to store audio resampled once up front, so
+        wav.scp lists plain paths instead of resampling pipes
+      manifest: Path to write hashes of each utterance's audio and transcript
+
+    Returns:
+      num_bad: Number of utterances excluded for bad audio
+    """
+    bad_utts = []
+
+    def exclude_bad(results):
+        for utt, result in results:
+            if isinstance(result, Exception):
+                bad_utts.append((utt[0], utt[3], result))
+            else:
+                yield utt, result
+
+    if resample_cache is not None and resample and resample_method != 'kaldi':
+        if shutil.which(resample_method) is None:
+            raise RuntimeError("{} not found for resampling audio".format(resample_method))
+        resampled = exclude_bad(map_audio_files(
+            lambda x: resample_to_cache(x, resample_cache, resample, resample_method),
+            utts, num_threads, key=lambda x: x[3]))
+        utts = ((*utt[:3], cached_path) for utt, cached_path in resampled)
+        # cached audio is already at the target rate
+        resample = 0
+    if probe_audio:
+        utts = exclude_bad(probe_audio_files(utts, num_threads, key=lambda x: x[3]))
+    else:
+        utts = ((utt, None) for utt in utts)
+    manifest_out = open(manifest, 'w', encoding='utf-8') if manifest is not None else None
+    with DataDirWriter(datadir, utt2dur=probe_audio, utt2num_frames=probe_audio) as writer:
+        for (utt_id, speaker, transcript, audio_path), info in utts:
+            dur = n_frames = None
+            if info is not None:
+                sample_rate, num_samples = info
+                dur = num_samples / sample_rate
+                if resample:
+                    num_samples = round(num_samples * resample / sample_rate)
+                    sample_rate = resample
+                n_frames = num_frames(num_samples, sample_rate, frame_length, frame_shift)
+                if not n_frames:
+                    bad_utts.append((utt_id, audio_path, "too short to extract features"))
+                    continue
+            wav = wav_entry(audio_path, resample, resample_method)
+            writer.write(utt_id, speaker, transcript, wav, dur, n_frames)
+            if manifest_out is not None:
+                manifest_out.write("{} {}\n".format(utt_id, utt_hash(audio_path, transcript, wav)))
+    if manifest_out is not None:
+        manifest_out.close()
+    if bad_audio is not None and (probe_audio or resample_cache is not None):
+        with open(bad_audio, 'w') as outf:
+            for utt_id, audio_path, err in bad_utts:
+                outf.write("{} {} {}\n".format(utt_id, audio_path, err))
+    return len(bad_utts)
+
+
+def sort_meta_chunk(lines, first_lineno, run_file, meta_opts):
+    """Parse chunk of metadata lines and spill records sorted by utterance ID
+
+    Args:
+      lines: List of lines from metadata file
+      first_lineno: Line number of first line in chunk, used to keep the last
+        of any duplicate utterance IDs when merging, as in process_meta
+      run_file: Path to write sorted records
+      meta_opts: Dict of keyword arguments to parse_meta_line
+
+    Returns:
+      run_file: Path to sorted run file
+    """
+    records = []
+    for lineno, line in enumerate(lines, first_lineno):
+        utt_id, speaker, transcript, audio_path = parse_meta_line(line, **meta_opts)
+        records.append((utt_id, lineno, speaker, transcript, audio_path))
+    # str comparison matches C locale byte order for UTF-8 text
+    records.sort()
+    write_run(records, run_file)
+    return run_file
+
+
+def _sort_meta_chunk(args):
+    return sort_meta_chunk(*args)
+
+
+def merge_meta_runs(run_files):
+    """Merge sorted run files, keeping the last record for each utterance ID
+
+    Yields:
+      record: (utt_id, lineno, speaker, transcript, audio_path) tuples,
+        sorted by utterance ID
+    """
+    prev = None
+    for record in merge_runs(run_files):
+        if prev is not None and record[0] != prev[0]:
+            yield prev
+        prev = record
+    if prev is not None:
+        yield prev
+
+
+def sort_meta_streaming(meta, audio_root, field_sep=' ', spkr_sep='-', spkr_in_wav=False,
+                        chunk_size=100000, num_procs=1, tmpdir=None):
+    """Sort metadata file by utterance ID using external merge sort
+
+    Metadata is parsed in chunks of lines, optionally across several worker
+    processes, and each chunk is sorted and spilled to disk before all runs are
+    merged, so memory use depends only on chunk size and not on the number of
+    utterances.
+
+    Args:
+      meta: Path to input metadata file, listing full audio paths and transcripts
+      audio_root: Longest common subpath across audio files
+      field_sep: Character separating fields in metadata file
+      spkr_sep: Character joining speaker ID prefix to utterance ID
+      spkr_in_wav: True if speaker ID is already part of audio filename
+      chunk_size: Number of metadata lines to sort in memory at a time
+      num_procs: Number of worker processes parsing and sorting chunks
+      tmpdir: Directory for temporary sorted runs (default: system temp dir)
+
+    Yields:
+      utt: Tuples like (utt_id, speaker, transcript, audio_path), sorted by
+        utterance ID and keeping the last line for any duplicate IDs
+    """
+    meta_opts = {'audio_root': audio_root, 'field_sep': field_sep,
+                 'spkr_sep': spkr_sep, 'spkr_in_wav': spkr_in_wav}
+    with tempfile.TemporaryDirectory(prefix='prep_data.', dir=tmpdir) as run_dir, \
+            open(meta) as inf:
+        chunks = iter(lambda: list(islice(inf, chunk_size)), [])
+        chunk_args = ((lines, i * chunk_size, os.path.join(run_dir, 'meta.{}'.format(i)),
+                       meta_opts) for i, lines in enumerate(chunks))
+        if num_procs > 1:
+            # only read ahead a few chunks per worker to keep memory bounded
+            run_files = []
+            pending = deque()
+            with Pool(num_procs) as pool:
+                for args in chunk_args:
+                    pending.append(pool.apply_async(_sort_meta_chunk, (args,)))
+                    if len(pending) >= 2 * num_procs:
+                        run_files.append(pending.popleft().get())
+                while pending:
+                    run_files.append(pending.popleft().get())
+        else:
+            run_files = [sort_meta_chunk(*args) for args in chunk_args]
+
+        for utt_id, _, *utt_info in merge_meta_runs(run_files):
+            yield (utt_id, *utt_info)
 
 
 if __name__ == '__main__':
@@ -118,19 +471,67 @@ if __name__ == '__main__':
     parser.add_argument('--spkr-in-wav', action='store_true',
         help="If speaker ID is already encoded in wav filename, don't add "
         "any extra prefix")
+    parser.add_argument('--stream', action='store_true',
+        help="Sort metadata in chunks spilled to disk instead of in memory, "
+        "for very large corpora")
+    parser.add_argument('--chunk-size', type=int, default=100000,
+        help="Number of metadata lines sorted in memory at a time when streaming")
+    parser.add_argument('--num-procs', type=int, default=1,
+        help="Number of parallel processes parsing metadata when streaming")
+    parser.add_argument('--tmpdir', type=str, default=None,
+        help="Directory for temporary files when streaming (default: system "
+        "temp dir)")
+    parser.add_argument('--probe-audio', action='store_true',
+        help="Read WAV/FLAC headers to write utt2dur and utt2num_frames, and "
+        "exclude utterances with unreadable or too-short audio (listed in "
+        "$workdir/bad_audio.txt)")
+    parser.add_argument('--resample-cache', type=str, default=None,
+        help="Resample audio once into this directory with sox or ffmpeg and "
+        "list the cached files in wav.scp, instead of resampling on the fly")
+    parser.add_argument('--num-threads', type=int, default=8,
+        help="Number of threads reading audio headers or resampling")
+    parser.add_argument('--frame-length', type=float, default=0.025,
+        help="Feature frame length in seconds, for utt2num_frames")
+    parser.add_argument('--frame-shift', type=float, default=0.01,
+        help="Feature frame shift in seconds, for utt2num_frames")
+    parser.add_argument('--incremental', action='store_true',
+        help="Write a manifest of utterance audio and transcripts to $workdir "
+        "and list utterances added, changed or removed since the last "
+        "committed manifest (run.sh commits it after extracting and validating features)")
     args = parser.parse_args()
 
     datadir = os.path.join(args.workdir, 'data/train')
     os.makedirs(datadir, exist_ok=True)
 
-    text, wavscp, utt2spk, spk2utt = process_meta(
-        args.meta, args.audio_root, args.resample, args.resample_method,
-        args.field_sep, args.spkr_sep, args.spkr_in_wav)
+    if args.stream:
+        utts = sort_meta_streaming(
+            args.meta, args.audio_root, args.field_sep, args.spkr_sep, args.spkr_in_wav,
+            args.chunk_size, args.num_procs, args.tmpdir)
+    else:
+        # str comparison matches C locale byte order for UTF-8 text
+        meta = read_meta(args.meta, args.audio_root, args.field_sep, args.spkr_sep,
+                         args.spkr_in_wav)
+        utts = ((utt_id, *meta[utt_id]) for utt_id in sorted(meta))
+
+    bad_audio = os.path.join(args.workdir, 'bad_audio.txt')
+    manifest = os.path.join(args.workdir, 'prep_manifest.txt')
+    new_manifest = manifest + '.new' if args.incremental else None
+    num_bad = write_data_dir(
+        utts, datadir, args.resample, args.resample_method, args.probe_audio,
+        args.num_threads, args.frame_length, args.frame_shift, bad_audio,
+        args.resample_cache, new_manifest)
+    if num_bad:
+        print("Excluded {} utterances with bad audio, see {}".format(
+            num_bad, bad_audio))
 
-    write_dict(text, os.path.join(datadir, 'text'))
-    write_dict(wavscp, os.path.join(datadir, 'wav.scp'))
-    write_dict(utt2spk, os.path.join(datadir, 'utt2spk'))
-    write_dict(spk2utt, os.path.join(datadir, 'spk2utt'))
+    if args.incremental:
+        # the new manifest is only committed once features have been
+        # extracted, so repeated runs still compare against the data which
+        # features were last extracted for
+        counts = diff_manifests(manifest, new_manifest, os.path.join(args.workdir, 'prep'))
+        print("Utterances added: {added}, changed: {changed}, removed: {removed} "
+              "(see {workdir}/prep_{{added,changed,removed}}.txt)".format(
+                  workdir=args.workdir, **counts))
 
     # write local mfcc.conf for downsampling audio to target rate using Kaldi
     if args.resample and args.resample_method == 'kaldi':
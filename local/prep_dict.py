@@ -2,15 +2,65 @@
 
 import argparse
 import os
-from collections import defaultdict
+import sys
+import tempfile
+from array import array
+from collections import Counter, defaultdict
+from itertools import groupby
 
+from external_sort import merge_runs, write_run
 
-def process_lexicon(lexicon, field_sep=' '):
+
+def load_vocab(text_file, enc='utf-8'):
+    """Load set of words used in transcripts
+
+    Args:
+      text_file: Path to Kaldi `text` data file
+      enc: File encoding for transcripts
+
+    Returns:
+      vocab: Set of words
+    """
+    vocab = set()
+    with open(text_file, encoding=enc) as inf:
+        for line in inf:
+            vocab.update(line.split()[1:])
+    return vocab
+
+
+def iter_lexicon(lexicon, field_sep=' ', vocab=None, counts=None):
+    """Iterate over entries in lexicon file
+
+    Args:
+      lexicon: Input lexicon file mapping words to space-separated phone strings
+      field_sep: Character separating words and pronunciations in lexicon
+      vocab: Optional set of words to keep entries for
+      counts: Optional Counter, updated with numbers of entries read and kept
+
+    Yields:
+      word: Word
+      pron: Space-separated phone string
+    """
+    n_read = n_kept = 0
+    with open(lexicon) as inf:
+        for line in inf:
+            word, pron = line.strip().split(field_sep, maxsplit=1)
+            n_read += 1
+            if vocab is None or word in vocab:
+                n_kept += 1
+                yield word, pron
+    if counts is not None:
+        counts.update(read=n_read, kept=n_kept)
+
+
+def process_lexicon(lexicon, field_sep=' ', vocab=None, counts=None):
     """Extract word-pronunciation mappings and phone set from lexicon file
 
     Args:
       lexicon: Input lexicon file mapping words to space-separated phone strings
       field_sep: Character separating words and pronunciations in lexicon
+      vocab: Optional set of words to keep entries for
+      counts: Optional Counter, updated with numbers of entries read and kept
 
     Returns:
       lex: Dict mapping words to sets of phone strings
@@ -18,14 +68,118 @@ def process_lexicon(lexicon, field_sep=' '):
     """
     lex = defaultdict(set)  # account for multiple pronunciations
     phones = set()
-    with open(lexicon) as inf:
-        for line in inf:
-            word, pron = line.strip().split(field_sep, maxsplit=1)
-            lex[word].update([pron])
-            phones.update(pron.split(' '))
+    for word, pron in iter_lexicon(lexicon, field_sep, vocab, counts):
+        lex[word].update([pron])
+        phones.update(pron.split(' '))
     return lex, phones
 
 
+def pack_pron(pron, phone_ids):
+    """Pack pronunciation as array of interned phone IDs
+
+    Args:
+      pron: Space-separated phone string
+      phone_ids: Dict mapping phones to integer IDs, updated with new phones
+
+    Returns:
+      packed: Bytes of unsigned 16-bit phone IDs
+    """
+    return array('H', [phone_ids.setdefault(phone, len(phone_ids))
+                       for phone in pron.split(' ')]).tobytes()
+
+
+def unpack_pron(packed, phones):
+    """Convert packed phone IDs back to pronunciation string
+
+    Args:
+      packed: Bytes of unsigned 16-bit phone IDs
+      phones: List of phones indexed by ID
+
+    Returns:
+      pron: Space-separated phone string
+    """
+    ids = array('H')
+    ids.frombytes(packed)
+    return ' '.join([phones[i] for i in ids])
+
+
+def process_lexicon_compact(lexicon, lexdir, oov, field_sep=' ', max_memory=1024,
+                            tmpdir=None, vocab=None, counts=None):
+    """Write lexicon file with added OOV entry, using little memory
+
+    Phones are interned to integer IDs and pronunciations stored as packed
+    arrays of those IDs, which are compared as bytes to drop duplicate
+    entries as they are read. If the entries we are holding exceed the memory
+    budget, they are sorted and spilled to disk, then all runs are merged at
+    the end. Words are written in sorted order, with multiple pronunciations
+    in order of first appearance in the input.
+
+    Args:
+      lexicon: Input lexicon file mapping words to space-separated phone strings
+      lexdir: Output directory
+      oov: List with token and phone symbol for out-of-vocabulary items
+      field_sep: Character separating words and pronunciations in lexicon
+      max_memory: Approximate memory budget for held entries, in MB
+      tmpdir: Directory for temporary sorted runs (default: system temp dir)
+      vocab: Optional set of words to keep entries for
+      counts: Optional Counter, updated with numbers of entries read and kept
+
+    Returns:
+      phones: Phone set
+    """
+    phone_ids = {}
+    budget = max_memory * 1024 * 1024
+    entry_template = "{} {}\n"
+    with tempfile.TemporaryDirectory(prefix='prep_dict.', dir=tmpdir) as run_dir:
+        run_files = []
+        # most words have a single pronunciation, so store that directly and
+        # only use a tuple for multiple pronunciations
+        lex = {}
+        held = 0
+
+        def spill():
+            records = [(word, len(run_files), lex[word]) for word in sorted(lex)]
+            run_files.append(os.path.join(run_dir, 'lex.{}'.format(len(run_files))))
+            write_run(records, run_files[-1])
+            lex.clear()
+
+        for word, pron in iter_lexicon(lexicon, field_sep, vocab, counts):
+            packed = pack_pron(pron, phone_ids)
+            prons = lex.get(word)
+            if prons is None:
+                lex[word] = packed
+                # dict slot overhead plus contents
+                held += 100 + sys.getsizeof(word) + sys.getsizeof(packed)
+            elif isinstance(prons, bytes):
+                if packed != prons:
+                    lex[word] = (prons, packed)
+                    held += 64 + sys.getsizeof(packed)
+            elif packed not in prons:
+                lex[word] = prons + (packed,)
+                held += 8 + sys.getsizeof(packed)
+            if held > budget:
+                spill()
+                held = 0
+        if run_files:
+            spill()
+            records = merge_runs(run_files)
+        else:
+            records = ((word, 0, lex[word]) for word in sorted(lex))
+
+        phones = sorted(phone_ids, key=phone_ids.get)
+        with open(os.path.join(lexdir, 'lexicon.txt'), 'w') as outf:
+            outf.write(entry_template.format(*oov))
+            for word, word_records in groupby(records, key=lambda x: x[0]):
+                # the same entries may be found in several runs
+                seen = set()
+                for _, _, prons in word_records:
+                    for packed in (prons,) if isinstance(prons, bytes) else prons:
+                        if packed not in seen:
+                            seen.add(packed)
+                            outf.write(entry_template.format(word, unpack_pron(packed, phones)))
+    return set(phones)
+
+
 def write_lexicon(lex, lexdir, oov):
     """Write lexicon file with added OOV entry
 
@@ -100,14 +254,39 @@ if __name__ == '__main__':
     parser.add_argument('--field-sep', type=str, default=' ',
         help="Character delimiting fields in lexicon file (if space, we "
         "only split on the first one)")
+    parser.add_argument('--text', type=str, default=None,
+        help="Kaldi data `text` file, to keep only lexicon entries for words "
+        "which occur in the transcripts")
+    parser.add_argument('--file-enc', type=str, default='utf-8',
+        help="File encoding for transcripts")
+    parser.add_argument('--compact', action='store_true',
+        help="Store pronunciations compactly and sort on disk if needed, for "
+        "very large lexicons")
+    parser.add_argument('--max-memory', type=int, default=1024,
+        help="Approximate memory budget in MB for lexicon entries in compact mode")
+    parser.add_argument('--tmpdir', type=str, default=None,
+        help="Directory for temporary files in compact mode (default: system "
+        "temp dir)")
     args = parser.parse_args()
 
     lexdir = os.path.join(args.workdir, 'data/local/dict')
     os.makedirs(lexdir, exist_ok=True)
 
-    lex, phones = process_lexicon(args.lex, args.field_sep)
-
-    write_lexicon(lex, lexdir, args.oov)
+    vocab = load_vocab(args.text, args.file_enc) if args.text else None
+    counts = Counter()
+    if args.compact:
+        phones = process_lexicon_compact(args.lex, lexdir, args.oov, args.field_sep,
+                                         args.max_memory, args.tmpdir, vocab, counts)
+    else:
+        lex, phones = process_lexicon(args.lex, args.field_sep, vocab, counts)
+        write_lexicon(lex, lexdir, args.oov)
+    if vocab is not None:
+        missing = vocab.difference(
+            word for word, _ in iter_lexicon(os.path.join(lexdir, 'lexicon.txt')))
+        print("Pruned lexicon to words in {}: kept {} of {} entries ({:.1%}), "
+              "{} of {} words in text have no pronunciation".format(
+                  args.text, counts['kept'], counts['read'],
+                  counts['kept'] / max(counts['read'], 1), len(missing), len(vocab)))
     write_phones(phones, lexdir)
     write_sil_phones(args.oov[1], lexdir)
     write_sil(lexdir)
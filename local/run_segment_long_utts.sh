@@ -188,7 +188,7 @@ if [ $stage -le 7 ]; then
   if [ $textgrid_output == true ]; then
     # convert alignments to Praat TextGrid format
     [ $textgrid_punc == true ] && textgrid_punc="--punc" || textgrid_punc=""
-    local/ctm_to_textgrid.py \
+    local/ctm_to_textgrid.py --nj $nj \
       --datadir $workdir/data_seg_clean --file-enc $file_enc $strip_pos $textgrid_punc \
       $workdir/data_seg_clean/ctm $workdir/data_seg_clean/ctm.phone $workdir/TextGrid
   fi
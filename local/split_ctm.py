@@ -4,10 +4,19 @@ import argparse
 import os
 import re
 
+from ctm_archive import CtmArchiveWriter
 
-def split_ctm(ctm_file, split_ctm_dir, strip_pos=False, enc='utf-8'):
-    """Split Kaldi CTM file per utterance and write to directory"""
+
+def split_ctm(ctm_file, split_ctm_dir, strip_pos=False, enc='utf-8', archive=False):
+    """Split Kaldi CTM file per utterance and write to directory
+
+    If archive is True, write a single indexed CTM archive to
+    split_ctm_dir/ctm instead of one file per utterance.
+    """
     os.makedirs(split_ctm_dir, exist_ok=True)
+    writer = None
+    if archive:
+        writer = CtmArchiveWriter(os.path.join(split_ctm_dir, 'ctm'), enc)
     word_pos = re.compile(r'_(B|I|E|S) $')
     prev_utt = ''
     lines = []
@@ -17,17 +26,22 @@ def split_ctm(ctm_file, split_ctm_dir, strip_pos=False, enc='utf-8'):
             if i == 0:
                 prev_utt = utt
             if prev_utt != utt:
-                write_ctm(split_ctm_dir, prev_utt, lines)
+                write_ctm(split_ctm_dir, prev_utt, lines, enc, writer)
                 lines = []
             if strip_pos:
                 line = re.sub(word_pos, '', line)
             lines.append(line)
             prev_utt = utt
         # final utt
-        write_ctm(split_ctm_dir, prev_utt, lines, enc)
+        write_ctm(split_ctm_dir, prev_utt, lines, enc, writer)
+    if writer is not None:
+        writer.close()
 
 
-def write_ctm(dirname, fname, lines, enc='utf-8'):
+def write_ctm(dirname, fname, lines, enc='utf-8', archive=None):
+    if archive is not None:
+        archive.write(fname, lines)
+        return
     with open(os.path.join(dirname, fname), "w", encoding=enc) as outf:
         outf.writelines(lines)
 
@@ -42,7 +56,11 @@ if __name__ == '__main__':
         help="Strip word position markers from phone CTM entries")
     parser.add_argument('--file-enc', type=str, default='utf-8',
         help="File encoding for input/output text")
+    parser.add_argument('--archive', action='store_true',
+        help="Write a single indexed CTM archive (split_ctm_dir/ctm with index "
+        "split_ctm_dir/ctm.idx) instead of one file per utterance")
     args = parser.parse_args()
 
-    split_ctm(args.ctm_file, args.split_ctm_dir, args.strip_pos, args.file_enc)
+    split_ctm(args.ctm_file, args.split_ctm_dir, args.strip_pos, args.file_enc,
+              args.archive)
 
@@ -4,6 +4,14 @@ import argparse
 import gzip
 import os
 import re
+from multiprocessing import Pool
+
+from ctm_archive import CtmArchiveWriter, concat_archives
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 re_state = re.compile(r'Transition-state (\d+): phone = (.+) hmm-state = (\d+) pdf = (\d+)')
@@ -11,23 +19,28 @@ re_trans = re.compile(r' Transition-id = (\d+) .* \[(.+)\]')
 re_wb = re.compile(r'_[BIES]$')
 
 
-def load_ali_gz(ali):
-    """Load gzipped state transition sequences for multiple utterances
+def load_ali_gz(ali, as_array=False):
+    """Read gzipped state transition sequences one utterance at a time
+
+    Lines are decoded lazily, so memory use is bounded by the longest single
+    utterance rather than the number of utterances in the file.
 
     Args:
       ali: Path to gzipped output from convert-ali
+      as_array: If True, yield transition sequences as NumPy int arrays
 
-    Returns:
-      utt_ali: Dict mapping utterance IDs to state transition sequences
+    Yields:
+      utt: Utterance ID
+      trans: List of integer state transition IDs for that utterance
     """
-    utt_ali = {}
     with gzip.open(ali, 'rt') as f:
-        lines = f.read().split('\n')
-        for line in lines:
+        for line in f:
             utt, *trans = line.strip().split(' ')
             if utt:
-                utt_ali[utt] = [int(i) for i in trans]
-    return utt_ali
+                if as_array:
+                    yield utt, np.array(trans, dtype=np.int64)
+                else:
+                    yield utt, [int(i) for i in trans]
 
 
 def parse_transitions(trans, strip_wb=True):
@@ -64,6 +77,29 @@ def parse_transitions(trans, strip_wb=True):
     return trans_phone
 
 
+def transition_arrays(trans_phone):
+    """Convert transition map to lookup tables indexed by transition ID
+
+    Args:
+      trans_phone: Dict mapping integer state transition IDs to tuples
+        like (phone, state), as returned by parse_transitions
+
+    Returns:
+      phones: List of phone labels, indexed by integer phone ID
+      phone_ids: NumPy int array mapping transition IDs to phone IDs
+      state_ids: NumPy int array mapping transition IDs to HMM states
+    """
+    phones = sorted(set(phone for phone, state in trans_phone.values()))
+    phone_to_id = {phone: i for i, phone in enumerate(phones)}
+    # transition IDs start from 1, leave index 0 unused
+    phone_ids = np.zeros(max(trans_phone) + 1, dtype=np.int64)
+    state_ids = np.zeros(max(trans_phone) + 1, dtype=np.int64)
+    for trans_id, (phone, state) in trans_phone.items():
+        phone_ids[trans_id] = phone_to_id[phone]
+        state_ids[trans_id] = int(state)
+    return phones, phone_ids, state_ids
+
+
 def trans_id_to_phone(ali, trans_phone):
     """Convert state transition sequence to phone states for one utterance
 
@@ -91,7 +127,30 @@ def trans_id_to_phone(ali, trans_phone):
     return phone_states
 
 
-def phone_to_ctm(ali, frame_shift, out_dir, utt):
+def trans_id_to_phone_array(ali, phone_ids, state_ids):
+    """Convert state transition sequence to phone states using array lookups
+
+    Array-backed equivalent of trans_id_to_phone.
+
+    Args:
+      ali: NumPy array of integer state transition IDs for one utterance
+      phone_ids: NumPy array mapping transition IDs to phone IDs
+      state_ids: NumPy array mapping transition IDs to HMM states
+
+    Returns:
+      frame_phones: NumPy array of phone IDs per frame
+      frame_states: NumPy array of emitting HMM states per frame
+    """
+    prev_phones = phone_ids[ali[:-1]]
+    curr_phones = phone_ids[ali[1:]]
+    # transition into a new phone => label with first state of curr_phone
+    new_phone = curr_phones != prev_phones
+    frame_phones = np.where(new_phone, curr_phones, prev_phones)
+    frame_states = np.where(new_phone, 0, state_ids[ali[:-1]])
+    return frame_phones, frame_states
+
+
+def phone_to_ctm(ali, frame_shift, out_dir, utt, archive=None):
     """Write phone state sequences to CTM file
     
     Args:
@@ -99,20 +158,120 @@ def phone_to_ctm(ali, frame_shift, out_dir, utt):
       frame_shift: Frame shift in milliseconds, to calculate durations
       out_dir: Output directory to write CTM file
       utt: Utterance ID, also used for CTM file name
+      archive: CtmArchiveWriter to append CTM lines to instead of writing
+        a separate file under out_dir
     """
     ctm_line = "{} 1 {:.3f} {:.3f} {}\n"
     frame_shift = frame_shift / 1000
     start = 0
     dur = frame_shift
-    with open(os.path.join(out_dir, utt), 'w') as outf:
-        for prev_phone, curr_phone in zip(ali, ali[1:]):
-            dur += frame_shift
-            if curr_phone != prev_phone:
-                outf.write(ctm_line.format(utt, start, dur, prev_phone))
-                start += dur
-                dur = 0
+    lines = []
+    for prev_phone, curr_phone in zip(ali, ali[1:]):
         dur += frame_shift
-        outf.write(ctm_line.format(utt, start, dur, curr_phone))
+        if curr_phone != prev_phone:
+            lines.append(ctm_line.format(utt, start, dur, prev_phone))
+            start += dur
+            dur = 0
+    dur += frame_shift
+    lines.append(ctm_line.format(utt, start, dur, curr_phone))
+    write_ctm(lines, out_dir, utt, archive)
+
+
+def phone_array_to_ctm(frame_phones, frame_states, phones, frame_shift, out_dir, utt,
+                       archive=None):
+    """Write phone state arrays to CTM file
+
+    Array-backed equivalent of phone_to_ctm. Run-length segmentation is done
+    with NumPy, so only segment boundaries are handled in Python.
+
+    Args:
+      frame_phones: NumPy array of phone IDs per frame for one utterance
+      frame_states: NumPy array of HMM states per frame
+      phones: List of phone labels, indexed by phone ID
+      frame_shift: Frame shift in milliseconds, to calculate durations
+      out_dir: Output directory to write CTM file
+      utt: Utterance ID, also used for CTM file name
+      archive: CtmArchiveWriter to append CTM lines to instead of writing
+        a separate file under out_dir
+    """
+    ctm_line = "{} 1 {:.3f} {:.3f} {}_{}\n"
+    frame_shift = frame_shift / 1000
+    n_frames = len(frame_phones)
+    changes = (np.diff(frame_phones) != 0) | (np.diff(frame_states) != 0)
+    seg_starts = np.concatenate(([0], np.flatnonzero(changes) + 1))
+    seg_frames = np.diff(np.append(seg_starts, n_frames))
+    # final non-emitting state has no frame in phone_states, but still counts
+    # towards utterance duration -- phone_to_ctm adds it to the first segment
+    seg_frames[0] += 1
+    seg_ends = np.cumsum(seg_frames)
+    lines = []
+    for start, end, phone, state in zip((seg_ends - seg_frames).tolist(),
+                                        seg_ends.tolist(),
+                                        frame_phones[seg_starts].tolist(),
+                                        frame_states[seg_starts].tolist()):
+        lines.append(ctm_line.format(
+            utt, start * frame_shift, (end - start) * frame_shift, phones[phone], state))
+    write_ctm(lines, out_dir, utt, archive)
+
+
+def write_ctm(lines, out_dir, utt, archive=None):
+    """Write CTM lines for one utterance to its own file or to an archive"""
+    if archive is not None:
+        archive.write(utt, lines)
+    else:
+        with open(os.path.join(out_dir, utt), 'w') as outf:
+            outf.write(''.join(lines))
+
+
+def convert_ali_job(ali_gz, trans_phone, frame_shift, out_dir, use_numpy=False,
+                    archive=None):
+    """Write phone-state CTM files for all utterances in one alignment job
+
+    Args:
+      ali_gz: Path to gzipped output from convert-ali for this job
+      trans_phone: Dict mapping integer state transition IDs to phone labels,
+        or tuple of (phones, phone_ids, state_ids) lookup tables from
+        transition_arrays if use_numpy is True
+      frame_shift: Frame shift in milliseconds, to calculate durations
+      out_dir: Output directory to write CTM files
+      use_numpy: Convert alignments using NumPy lookup tables
+      archive: If set, path to write a single indexed CTM archive for this
+        job instead of per-utterance files
+
+    Returns:
+      n_utts: Number of utterances converted
+    """
+    writer = CtmArchiveWriter(archive) if archive is not None else None
+    n_utts = 0
+    for utt, ali in load_ali_gz(ali_gz, as_array=use_numpy):
+        if use_numpy:
+            phones, phone_ids, state_ids = trans_phone
+            frame_phones, frame_states = trans_id_to_phone_array(ali, phone_ids, state_ids)
+            phone_array_to_ctm(frame_phones, frame_states, phones, frame_shift, out_dir,
+                               utt, writer)
+        else:
+            phone_states = trans_id_to_phone(ali, trans_phone)
+            phone_to_ctm(phone_states, frame_shift, out_dir, utt, writer)
+        n_utts += 1
+    if writer is not None:
+        writer.close()
+    return n_utts
+
+
+# Transition table for pool workers. Set once per worker by the pool
+# initializer -- with the default fork start method this is inherited
+# copy-on-write from the parent instead of being pickled per job
+_trans_phone = None
+
+
+def _init_worker(trans_phone):
+    global _trans_phone
+    _trans_phone = trans_phone
+
+
+def _convert_ali_job(args):
+    ali_gz, frame_shift, out_dir, use_numpy, archive = args
+    return convert_ali_job(ali_gz, _trans_phone, frame_shift, out_dir, use_numpy, archive)
 
 
 if __name__ == '__main__':
@@ -131,13 +290,38 @@ if __name__ == '__main__':
     parser.add_argument('--nj', type=int, default=4,
         help='Number of parallel jobs run during alignment, i.e. how many split ali '
         'files to process')
+    parser.add_argument('--num-procs', type=int, default=1,
+        help='Number of worker processes converting split ali files concurrently')
+    parser.add_argument('--use-numpy', action='store_true',
+        help='Convert alignments using NumPy lookup tables (much faster for '
+        'large alignment sets)')
+    parser.add_argument('--archive', action='store_true',
+        help='Write a single indexed CTM archive (out_dir/ctm with index '
+        'out_dir/ctm.idx) instead of one file per utterance')
     args = parser.parse_args()
+    if args.use_numpy and np is None:
+        parser.error('--use-numpy requires NumPy to be installed')
 
     os.makedirs(args.out_dir, exist_ok=True)
     trans_phone = parse_transitions(args.transitions)
-    for i in range(1, args.nj + 1):
-        utt_ali = load_ali_gz(os.path.join(args.ali_dir, 'ali.trans.{}.gz'.format(i)))
-        for utt, ali in utt_ali.items():
-            phone_states = trans_id_to_phone(ali, trans_phone)
-            phone_to_ctm(phone_states, args.frame_shift, args.out_dir, utt)
+    if args.use_numpy:
+        trans_phone = transition_arrays(trans_phone)
+    ali_gzs = [os.path.join(args.ali_dir, 'ali.trans.{}.gz'.format(i))
+               for i in range(1, args.nj + 1)]
+    # archive mode: write one archive per job, then join them in job order
+    archive = os.path.join(args.out_dir, 'ctm')
+    job_archives = ['{}.{}'.format(archive, i) if args.archive else None
+                    for i in range(1, args.nj + 1)]
+    if args.num_procs > 1:
+        job_args = [(ali_gz, args.frame_shift, args.out_dir, args.use_numpy, job_archive)
+                    for ali_gz, job_archive in zip(ali_gzs, job_archives)]
+        with Pool(min(args.num_procs, args.nj), _init_worker, (trans_phone,)) as pool:
+            for _ in pool.imap_unordered(_convert_ali_job, job_args):
+                pass
+    else:
+        for ali_gz, job_archive in zip(ali_gzs, job_archives):
+            convert_ali_job(ali_gz, trans_phone, args.frame_shift, args.out_dir,
+                            args.use_numpy, job_archive)
+    if args.archive:
+        concat_archives(job_archives, archive)
 
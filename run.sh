@@ -7,15 +7,22 @@ audio_root=
 workdir=align
 oov='<unk>,SPN'
 exit_on_oov=false
+max_oov_utts=0
 filter_oov=false
 oov_phone_lm=false
 resample=0
 resample_method=sox
+resample_cache=
 mfcc_config=conf/mfcc.conf
 spkr_sep='-'
 spkr_in_wav=false
 meta_field_sep=' '
+stream_meta=false
+probe_audio=false
+incremental=false
 lex_field_sep=' '
+compact_lex=false
+prune_lex=false
 splits='2000,5000,10000'
 split_per_utt=false
 boost_silence=1.0
@@ -24,6 +31,7 @@ beam=10
 retry_beam=40
 careful=false
 strip_pos=false
+ctm_archive=false
 textgrid_output=false
 textgrid_punc=false
 file_enc='utf-8'
@@ -39,15 +47,22 @@ Options:
   --workdir align               # output directory for alignment files
   --oov '<unk>,SPN'             # symbol to use for out-of-vocabulary items
   --exit-on-oov false           # stop early if OOV items found in training data
+  --max-oov-utts 0              # with --exit-on-oov, stop checking after this many OOV utterances
   --filter-oov false            # exclude utterances with OOV items from alignment
   --oov-phone-lm false          # use phone-level LM for OOV items
   --resample 16000              # convert audio to new sampling rate (off by default)
   --resample-method sox         # tool to resample audio (sox|ffmpeg|kaldi)
+  --resample-cache ''           # resample audio once into this directory (sox|ffmpeg)
   --mfcc-config conf/mfcc.conf  # config file for mfcc extraction
   --spkr-sep '-'                # character joining speaker prefix to utterance IDs
   --spkr-in-wav false           # speaker prefix already part of audio filenames
   --meta-field-sep ' '          # field separator in metadata file
+  --stream-meta false           # sort metadata on disk in chunks (large corpora)
+  --probe-audio false           # get utt2dur from WAV/FLAC headers, skip bad audio
+  --incremental false           # only extract features for new or changed utterances
   --lex-field-sep ' '           # field separator in lexicon
+  --compact-lex false           # build lexicon with less memory (very large lexicons)
+  --prune-lex false             # keep only lexicon entries for words in training text
   --splits 2000,5000,10000      # number of utterances to split each data partition
   --split-per-utt false         # split data without regard to speaker labels
   --boost-silence 1.0           # factor to boost silence models (none by default)
@@ -56,6 +71,7 @@ Options:
   --retry-beam 40               # retry beam width for failed alignments (0 to disable)
   --careful false               # enable careful alignment to better detect failures
   --strip-pos false             # strip word position labels from phone CTM outputs
+  --ctm-archive false           # write CTM outputs to single indexed archives
   --textgrid-output false       # also write alignments to Praat TextGrid format
   --textgrid-punc false         # restore punctuation symbols in TextGrids
   --file-enc 'utf-8'            # text file encoding
@@ -81,14 +97,21 @@ IFS=, read short mid long <<< "$splits"
 if [ $stage -le 0 ]; then
   # prepare data files from metadata input
   [ $spkr_in_wav == true ] && spkr_in_wav="--spkr-in-wav" || spkr_in_wav=""
+  [ $stream_meta == true ] && stream_meta="--stream --num-procs $nj" || stream_meta=""
+  [ $probe_audio == true ] && probe_audio="--probe-audio --frame-shift $frame_shift" || probe_audio=""
+  [ -n "$resample_cache" ] && resample_cache="--resample-cache $resample_cache --num-threads $nj"
+  [ $incremental == true ] && incremental_prep="--incremental" || incremental_prep=""
   [ -n "$meta" ] && local/prep_data.py \
     $meta $audio_root --workdir $workdir \
     --resample $resample --resample-method $resample_method \
-    $spkr_in_wav --spkr-sep "$spkr_sep" --field-sep "$meta_field_sep"
+    $spkr_in_wav --spkr-sep "$spkr_sep" --field-sep "$meta_field_sep" \
+    $stream_meta $probe_audio $resample_cache $incremental_prep
   # prepare dictionary files from lexicon input
+  [ $compact_lex == true ] && compact_lex="--compact" || compact_lex=""
+  [ $prune_lex == true ] && prune_lex="--text $data/train/text --file-enc $file_enc" || prune_lex=""
   [ -n "$lex" ] && local/prep_dict.py \
     $lex --workdir $workdir --oov ${oov/,/ } \
-    --field-sep "$lex_field_sep"
+    --field-sep "$lex_field_sep" $compact_lex $prune_lex
 fi
 
 if [ $stage -le 1 ]; then
@@ -101,8 +124,8 @@ if [ $stage -le 1 ]; then
   fi
   utils/prepare_lang.sh $unk_fst $data/local/dict \
     ${oov%,*} $data/local/lang $data/lang
-  [ $exit_on_oov = true ] && warn_on_oov="--warn-on-oov" || warn_on_oov=""
-  local/check_oov.py --workdir $workdir --file-enc $file_enc \
+  [ $exit_on_oov = true ] && warn_on_oov="--warn-on-oov --max-oov-utts $max_oov_utts" || warn_on_oov=""
+  local/check_oov.py --workdir $workdir --file-enc $file_enc --num-procs $nj \
     $data/lang/words.txt $data/train/text \
     $warn_on_oov || (echo "Check OOV files: $workdir/oov_{words,utts}.txt"; exit 1)
   if [ $filter_oov = true ]; then
@@ -115,13 +138,60 @@ fi
 
 if [ $stage -le 2 ]; then
   [ "$resample_method" == "kaldi" ] && mfcc_config=$workdir/conf/mfcc.conf
-  steps/make_mfcc.sh --cmd "$train_cmd" --nj $nj \
-    --mfcc-config $mfcc_config \
-    $data/train $data/train/mfcc $data/train/mfcc
+  if [ $incremental = true ] && [ -f $data/train/feats.scp ] && [ -f $workdir/prep_changed.txt ]; then
+    # keep existing features for unchanged utterances and extract features
+    # for all others, i.e. those changed since features were last extracted
+    # plus any without features at all
+    utils/filter_scp.pl $data/train/utt2spk $data/train/feats.scp | \
+      utils/filter_scp.pl --exclude $workdir/prep_changed.txt > $data/train/feats.scp.keep
+    utils/filter_scp.pl --exclude $data/train/feats.scp.keep $data/train/utt2spk | \
+      cut -d' ' -f1 > $data/train/delta_utts
+    delta=
+    if [ -s $data/train/delta_utts ]; then
+      # unique name so feature archives from earlier deltas are not overwritten
+      delta=$data/train_delta.$(date +%s)
+      utils/subset_data_dir.sh --utt-list $data/train/delta_utts $data/train $delta
+      rm -f $delta/{feats,cmvn}.scp $delta/{utt2dur,utt2num_frames}
+      delta_nj=$(wc -l < $delta/spk2utt)
+      [ $delta_nj -gt $nj ] && delta_nj=$nj
+      steps/make_mfcc.sh --cmd "$train_cmd" --nj $delta_nj \
+        --mfcc-config $mfcc_config \
+        $delta $data/train/mfcc $data/train/mfcc
+    fi
+    cat $data/train/feats.scp.keep ${delta:+$delta/feats.scp} | LC_ALL=C sort -k1,1 \
+      > $data/train/feats.scp
+    # durations are written alongside features, so merge them the same way,
+    # or drop them to be recomputed if the new utterances have none
+    for f in utt2dur utt2num_frames; do
+      if [ -f $data/train/$f ] && { [ -z "$delta" ] || [ -f $delta/$f ]; }; then
+        utils/filter_scp.pl $data/train/feats.scp.keep $data/train/$f | \
+          cat - ${delta:+$delta/$f} | LC_ALL=C sort -k1,1 > $data/train/$f.tmp
+        mv $data/train/$f.tmp $data/train/$f
+      else
+        rm -f $data/train/$f
+      fi
+    done
+    [ -n "$delta" ] && rm -r $delta
+    rm -f $data/train/feats.scp.keep $data/train/delta_utts
+  else
+    steps/make_mfcc.sh --cmd "$train_cmd" --nj $nj \
+      --mfcc-config $mfcc_config \
+      $data/train $data/train/mfcc $data/train/mfcc
+  fi
+  # CMVN stats are per speaker, so recompute them for the full data
   steps/compute_cmvn_stats.sh \
     $data/train $data/train/mfcc $data/train/mfcc
-  utils/fix_data_dir.sh $data/train
-  local/validate_data_dir.sh $data/train
+  # single-pass check, only fix up the data dir (e.g. if feature extraction
+  # failed for some utterances) if needed
+  local/data_dir.py --file-enc $file_enc $data/train || {
+    utils/fix_data_dir.sh $data/train
+    local/validate_data_dir.sh $data/train
+  }
+  # features are up to date with this data prep, so later runs compare
+  # against it
+  if [ -f $workdir/prep_manifest.txt.new ]; then
+    mv $workdir/prep_manifest.txt.new $workdir/prep_manifest.txt
+  fi
 fi
 
 if [ $stage -le 3 ]; then
@@ -221,15 +291,16 @@ fi
 if [ $stage -le 10 ]; then
   # split CTM files for final per-utterance outputs
   [ $strip_pos == true ] && strip_pos="--strip-pos" || strip_pos=""
-  local/split_ctm.py $strip_pos --file-enc $file_enc \
+  [ $ctm_archive == true ] && ctm_archive="--archive" || ctm_archive=""
+  local/split_ctm.py $strip_pos $ctm_archive --file-enc $file_enc \
     $exp/tri4b_ali_train/ctm $workdir/word
-  local/split_ctm.py $strip_pos --file-enc $file_enc \
+  local/split_ctm.py $strip_pos $ctm_archive --file-enc $file_enc \
     $exp/tri4b_ali_train/ctm.phone $workdir/phone
 
   # convert alignments to Praat TextGrid format
   if [ $textgrid_output == true ]; then
     [ $textgrid_punc == true ] && textgrid_punc="--punc" || textgrid_punc=""
-    local/ctm_to_textgrid.py \
+    local/ctm_to_textgrid.py --nj $nj \
       --datadir $data/train --file-enc $file_enc $strip_pos $textgrid_punc \
       $exp/tri4b_ali_train/ctm $exp/tri4b_ali_train/ctm.phone $workdir/TextGrid
   fi